@@ -31,6 +31,7 @@ DEFAULT_CONFIG = {
     "username": "", 
     "password": "", 
     "email": "", 
+    "refresh_token": "",  # Lets reconnects skip the password login
     "auto_connect": False, 
     "check_updates_on_startup": True,  # Check for updates when NVDA starts
     "show_timestamps": True,  # Show date/time in messages
@@ -68,6 +69,10 @@ DEFAULT_CONFIG = {
 UPDATE_CHECK_URL = "https://raw.githubusercontent.com/AnimalMetal/Drago-Chat/main/version.json"
 TEST_UPDATE_MODE = False  # Set to True to test update system without GitHub
 
+# Sequence numbers remembered per chat to drop duplicate messages; the
+# server keeps 200 per chat for resync, so older ones can't come back
+SEEN_SEQS_PER_CHAT = 1000
+
 # Sound file paths - expects WAV files in the sounds folder
 SOUNDS_DIR = os.path.join(addon_dir, "sounds")
 SOUNDS = {
@@ -101,9 +106,14 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         self.unread_messages = {}
         self.token = None
         self.reconnect_count = 0
+        self.connect_refused = None  # Reason the server gave for refusing the last socket
         self.message_queue = queue.Queue()
         self.manual_disconnect = False
         self.reconnect_timer = None
+        self.token_refresh_timer = None
+        self.presence_version = None  # Version of the last presence snapshot/batch applied
+        self.last_seqs = {}  # {chat_id: resync cursor, no gaps up to this sequence number}
+        self.seen_seqs = {}  # {chat_id: set of recently seen sequence numbers}
         if requests is None or websocket is None:
             wx.CallLater(1000, lambda: ui.message(_("Error: Libraries missing")))
             return
@@ -208,6 +218,8 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         t, d = msg.get('type'), msg.get('data', {})
         if t == 'new_message':
             cid, m = d.get('chat_id'), d.get('message')
+            if not self.track_seq(cid, m):
+                return  # Already received through resync or missed messages
             sender = m.get('sender', 'Unknown')
             message_text = m.get('message', '')
             
@@ -282,6 +294,23 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             
             if self.chat_window: self.chat_window.on_new_message(cid, m)
             
+        elif t == 'missed_messages':
+            # Messages the server kept while we were offline, delivered in one batch
+            self.handle_missed_messages(d.get('messages', []))
+            
+        elif t == 'resync_result':
+            # Gap fill after a reconnect; may overlap with missed messages
+            items = []
+            for cid, result in d.get('chats', {}).items():
+                items.extend({'chat_id': cid, 'message': m} for m in result.get('messages', []))
+                if not result.get('complete', True):
+                    print(f"Resync for {cid} incomplete, older messages are no longer on the server")
+            self.handle_missed_messages(items)
+            # The server sent everything it still has, so gaps left now are for good
+            for cid in d.get('chats', {}):
+                if self.seen_seqs.get(cid):
+                    self.last_seqs[cid] = max(self.last_seqs.get(cid, 0), max(self.seen_seqs[cid]))
+            
         elif t == 'user_online':
             u = d.get('username')
             self.playSound('user_online')
@@ -300,6 +329,42 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                 if f['username'] == u: f['status'] = 'offline'; break
             if self.chat_window: wx.CallAfter(self.chat_window.refresh_friends)
             
+        elif t == 'authenticated':
+            # Needs a server with handshake auth, which always sends the
+            # presence snapshot (older servers never authenticate this client)
+            presence = d.get('presence', {})
+            self.presence_version = presence.get('version', 0)
+            self.friends = [{'username': u, 'status': status} for u, status in presence.get('friends', {}).items()]
+            if self.chat_window: wx.CallAfter(self.chat_window.refresh_friends)
+            self.request_resync()
+            
+        elif t == 'presence_batch':
+            # Batches are numbered; if one was missed, fetch the full list again
+            version, since = d.get('version'), d.get('since')
+            if version is not None and self.presence_version is not None:
+                if version <= self.presence_version:
+                    return  # Already covered by the snapshot
+                if since > self.presence_version + 1:
+                    self.load_friends()
+            if version is not None:
+                self.presence_version = version
+            
+            # Several presence changes at once: one sound, one announcement, one refresh
+            changes = d.get('changes', {})
+            came_online = [u for u, status in changes.items() if status == 'online']
+            went_offline = [u for u, status in changes.items() if status == 'offline']
+            for f in self.friends:
+                if f['username'] in changes: f['status'] = changes[f['username']]
+            if came_online:
+                self.playSound('user_online')
+                if self.config.get('speak_user_online', True):
+                    ui.message(_("{user} is online").format(user=", ".join(came_online)))
+            if went_offline:
+                if not came_online: self.playSound('user_offline')
+                if self.config.get('speak_user_offline', True):
+                    ui.message(_("{user} is offline").format(user=", ".join(went_offline)))
+            if self.chat_window: wx.CallAfter(self.chat_window.refresh_friends)
+            
         elif t == 'friend_request':
             self.playSound('friend_request')
             if self.config.get('speak_friend_request', True):
@@ -311,6 +376,55 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             ui.message(_("{user} accepted friend request").format(user=d.get("username")))
             self.load_friends()
     
+    def track_seq(self, cid, m):
+        """Remember a message's sequence number; False for a message already seen.
+        Live messages, missed messages and resync batches overlap and can
+        arrive in any order, so every number is checked, not just the newest."""
+        seq = m.get('seq')
+        if seq is None: return True
+        seen = self.seen_seqs.setdefault(cid, set())
+        if seq in seen: return False
+        seen.add(seq)
+        if len(seen) > SEEN_SEQS_PER_CHAT: seen.discard(min(seen))
+        # The resync cursor only moves past numbers with nothing missing before them
+        cursor = self.last_seqs.get(cid, seq)
+        while cursor + 1 in seen: cursor += 1
+        self.last_seqs[cid] = cursor
+        return True
+    
+    def handle_missed_messages(self, items):
+        """Save and announce a batch of messages received while we were away"""
+        items = [item for item in items if self.track_seq(item.get('chat_id'), item.get('message', {}))]
+        if not items: return
+        if any(item.get('chat_id') not in self.chats for item in items):
+            self.load_chats()
+        own_username = self.config.get('username')
+        missed = 0
+        for item in items:
+            cid, m = item.get('chat_id'), item.get('message', {})
+            if self.config.get('save_messages_locally', True):
+                self.save_message_locally(cid, m)
+            if cid in self.chats:
+                self.chats[cid]['last_message_time'] = m.get('timestamp', datetime.now().isoformat())
+            if m.get('sender') != own_username:
+                missed += 1
+                self.unread_messages[cid] = self.unread_messages.get(cid, 0) + 1
+                if cid in self.chats:
+                    self.chats[cid]['unread_count'] = self.unread_messages[cid]
+        if missed:
+            self.playSound('message_received')
+            if self.config.get('speak_message_received', True):
+                ui.message(_("{count} missed messages").format(count=missed))
+        if self.chat_window: wx.CallAfter(self.chat_window.refresh_chats)
+    
+    def request_resync(self):
+        """Ask the server for messages sent while we were disconnected"""
+        if not self.last_seqs or not self.ws: return
+        try:
+            self.ws.send('42' + json.dumps(["resync", self.last_seqs]))
+        except Exception:
+            pass
+    
     @script(description="Open chat", category="Drago Chat")
     def script_openChat(self, gesture): 
         try:
@@ -354,23 +468,94 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         self.manual_disconnect = False
         threading.Thread(target=self._connect_thread, daemon=True).start()
     
+    def authenticate(self, url):
+        """Get an access token, resuming with the refresh token when we have one.
+        Returns the login response data, or None if the server rejected us."""
+        refresh_token = self.config.get('refresh_token')
+        if refresh_token:
+            # The server rotates refresh tokens: the one we sent is now revoked
+            resp = requests.post(f'{url}/api/auth/refresh', json={'refresh_token': refresh_token}, timeout=10)
+            data = resp.json() if resp.status_code == 200 else {}
+            if data.get('username') == self.config['username']:
+                self.store_refresh_token(data.get('refresh_token', ""))
+                return data
+            # Rejected (revoked or expired) or another account's - fall back to the password
+            if data.get('refresh_token'):
+                self.revoke_tokens(url, data['refresh_token'])
+            self.store_refresh_token("")
+        resp = requests.post(f'{url}/api/auth/login', json={'username': self.config['username'], 'password': self.config['password']}, timeout=10)
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        self.store_refresh_token(data.get('refresh_token', ""))
+        return data
+    
+    def store_refresh_token(self, refresh_token):
+        """Keep the refresh token for the next reconnect; the server has
+        already revoked the one it replaces when it came from a refresh"""
+        self.config['refresh_token'] = refresh_token
+        self.saveConfig()
+    
+    def revoke_tokens(self, url, refresh_token=None, token=None):
+        """Log a session out on the server in the background, so its refresh
+        token and access token stop working"""
+        if not url or not (refresh_token or token):
+            return
+        def logout():
+            try:
+                headers = {'Authorization': f'Bearer {token}'} if token else {}
+                requests.post(f'{url}/api/auth/logout', json={'refresh_token': refresh_token or ""},
+                              headers=headers, timeout=5)
+            except Exception:
+                pass
+        threading.Thread(target=logout).start()
+    
+    def logout(self):
+        """Revoke this session's tokens and forget them; the next connect
+        logs in with the password"""
+        self.revoke_tokens(self.config.get('server_url'), self.config.get('refresh_token'), self.token)
+        self.token = None
+        if self.config.get('refresh_token'):
+            self.store_refresh_token("")
+    
+    def schedule_token_refresh(self, expires_in, delay=None):
+        """Renew the access token shortly before it expires"""
+        if self.token_refresh_timer:
+            self.token_refresh_timer.cancel()
+        if not expires_in:
+            return
+        def renew():
+            if not self.connected: return
+            try:
+                data = self.authenticate(self.config['server_url'])
+                if data:
+                    self.token = data.get('token')
+                    self.schedule_token_refresh(data.get('expires_in'))
+            except Exception:
+                # Try again in a minute; the socket stays up meanwhile
+                self.schedule_token_refresh(expires_in, delay=60)
+        self.token_refresh_timer = threading.Timer(delay or expires_in * 0.8, renew)
+        self.token_refresh_timer.daemon = True
+        self.token_refresh_timer.start()
+    
     def _connect_thread(self):
         try:
             url = self.config['server_url']
-            resp = requests.post(f'{url}/api/auth/login', json={'username': self.config['username'], 'password': self.config['password']}, timeout=10)
-            if resp.status_code == 200:
-                self.token = resp.json().get('token')
+            data = self.authenticate(url)
+            if data:
+                self.token = data.get('token')
+                self.schedule_token_refresh(data.get('expires_in'))
                 self.connected = True
                 was_reconnecting = self.reconnect_count > 0
-                self.reconnect_count = 0
                 
                 # Only announce and beep if this was a manual connection (not auto-reconnect)
                 if not was_reconnecting:
                     wx.CallAfter(lambda: (self.playSound('connected'), ui.message(_("Connected"))))
                 # Silent reconnection - no beep, no message
                 
+                # Friends and their presence arrive with the 'authenticated' event
+                self.presence_version = None
                 self.startWebSocket()
-                wx.CallAfter(self.load_friends)
                 wx.CallAfter(self.load_chats)
             else: wx.CallAfter(lambda: ui.message(_("Login failed")))
         except requests.exceptions.Timeout:
@@ -389,6 +574,9 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             return
         self.reconnect_count += 1
         delay = self.config.get('reconnect_delay', 3)
+        if self.connect_refused == 'busy':
+            # Server is at its connection limit: back off instead of piling on
+            delay = min(delay * 2 ** self.reconnect_count, 300)
         wx.CallLater(delay * 1000, self.connect)
     
     def startWebSocket(self):
@@ -423,12 +611,9 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
     
     def on_ws_open(self, ws):
         try:
-            # Reset reconnect count on successful connection
-            self.reconnect_count = 0
-            ws.send('40')
-            time.sleep(0.1)
-            auth_msg = f'42["authenticate",{{"token":"{self.token}"}}]'
-            ws.send(auth_msg)
+            # Authenticate in the connect packet itself, no extra round-trip.
+            # The reconnect count is only reset once the server accepts it.
+            ws.send('40' + json.dumps({'token': self.token}))
             # Start heartbeat to keep connection alive
             self.start_heartbeat()
         except: pass
@@ -455,15 +640,38 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                 ws.send('3')
                 return
             
-            # Handle regular messages
+            # Connect accepted - only now does the connection count as working
+            if msg.startswith('40'):
+                self.reconnect_count = 0
+                self.connect_refused = None
+                return
+            
+            # Connect refused: 'unauthorized' (expired or revoked token) reconnects,
+            # which logs in again
+            if msg.startswith('44'):
+                try: self.connect_refused = json.loads(msg[2:]).get('message')
+                except Exception: self.connect_refused = None
+                ws.close()
+                return
+            
+            # Handle regular messages; an id before the payload asks for an
+            # ack (the server keeps missed messages until it gets one)
             if msg.startswith('42'):
-                data = json.loads(msg[2:])
+                body = msg[2:]
+                ack_id = body[:len(body) - len(body.lstrip('0123456789'))]
+                data = json.loads(body[len(ack_id):])
                 if isinstance(data, list) and len(data) >= 2:
                     event, payload = data[0], data[1]
                     self.message_queue.put({'type': event, 'data': payload})
+                if ack_id:
+                    ws.send('43' + ack_id + '[]')
         except: pass
     
-    def on_ws_error(self, ws, error): pass
+    def on_ws_error(self, ws, error):
+        # A full server refuses the WebSocket handshake itself with HTTP 401
+        # "busy"; reconnects back off instead of piling on
+        if getattr(error, 'status_code', None) == 401 and b'busy' in (getattr(error, 'resp_body', None) or b''):
+            self.connect_refused = 'busy'
     
     def on_ws_close(self, ws, close_status_code, close_msg):
         was_connected = self.connected
@@ -488,10 +696,14 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         if self.reconnect_timer:
             self.reconnect_timer.Stop()
             self.reconnect_timer = None
+        if self.token_refresh_timer:
+            self.token_refresh_timer.cancel()
+            self.token_refresh_timer = None
         if self.ws:
             try: self.ws.close()
             except: pass
             self.ws = None
+        self.logout()
         
         # Clear chat list when disconnected
         self.chats = {}
@@ -2657,8 +2869,10 @@ class AccountDialog(wx.Dialog):
                 if resp.status_code == 200:
                     wx.CallAfter(lambda: (ui.message(f"Account created! Welcome {username}"), 
                                          self.plugin.playSound('connected')))
-                    self.plugin.config.update({'username': username, 'password': password, 'email': email})
-                    self.plugin.saveConfig()
+                    # The new account replaces the stored one, on the server it was created on
+                    self.plugin.logout()
+                    self.plugin.config.update({'server_url': server_url, 'username': username, 'password': password, 'email': email})
+                    self.plugin.store_refresh_token(resp.json().get('refresh_token', ""))
                 elif resp.status_code == 409:
                     wx.CallAfter(lambda: ui.message(_("Username taken")))
                 else:
@@ -2669,6 +2883,10 @@ class AccountDialog(wx.Dialog):
         threading.Thread(target=register, daemon=True).start()
     
     def onSave(self, e):
+        # A stored session only belongs to the account it was issued for
+        account = (self.serverText.GetValue(), self.userText.GetValue(), self.passText.GetValue())
+        if account != (self.plugin.config.get("server_url"), self.plugin.config.get("username"), self.plugin.config.get("password")):
+            self.plugin.logout()
         self.plugin.config.update({
             "server_url": self.serverText.GetValue(),
             "username": self.userText.GetValue(),
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Benchmark: messages per second with 1, 2 and 4 cluster workers.
+
+Starts the bus broker and N workers on one port with the sqlite backend, as
+server.py does with CLUSTER_WORKERS = N, then has PAIRS pairs of users chat
+in private chats, one client process per pair. Each sender keeps up to
+WINDOW messages unacknowledged; the rate counts messages that reached the
+other side of their chat. Chats are spread over the workers, so the rate
+should grow with the workers until the CPU count or the bus caps it.
+
+Unlike the other benchmarks this one runs the real server processes, not
+the in-process harness.
+
+    python benchmarks/bench_cluster.py
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import socketio
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+WORKER_COUNTS = [1, 2, 4]
+PAIRS = 16
+MESSAGES = 500  # Per pair
+WINDOW = 10
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(check, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError('Timed out waiting for the cluster')
+
+
+def post(port, path, data, token=None):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}{path}', data=json.dumps(data).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def start_cluster(workers, data_dir, port):
+    """Broker plus `workers` workers sharing one port; returns the processes"""
+    bus = os.path.join(data_dir, f'bus{workers}.sock')
+    log_path = os.path.join(data_dir, f'cluster{workers}.log')
+    env = dict(
+        os.environ, NVDA_CHAT_DATA=data_dir, NVDA_CHAT_STORAGE='sqlite', NVDA_CHAT_WORKERS=str(workers),
+        NVDA_CHAT_BUS=f'unix://{bus}', NVDA_CHAT_PORT=str(port), PYTHONUNBUFFERED='1'
+    )
+    log = open(log_path, 'w')
+    processes = [subprocess.Popen(
+        [sys.executable, '-c', f'import server; server.run_bus_broker({bus!r})'],
+        cwd=os.path.dirname(SERVER), env=env, stdout=log, stderr=subprocess.STDOUT
+    )]
+    wait_for(lambda: os.path.exists(bus))
+    for node in range(workers):
+        processes.append(subprocess.Popen(
+            [sys.executable, SERVER, 'worker', str(node)], env=env, stdout=log, stderr=subprocess.STDOUT
+        ))
+
+    def all_serving():
+        with open(log_path, encoding='utf-8') as f:
+            return f.read().count('serving on port') == workers
+    wait_for(all_serving)
+    log.close()
+    return processes
+
+
+def stop_cluster(processes):
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def run_pair(port, sender_token, receiver_token, chat_id, barrier, results):
+    """Send MESSAGES into one chat and time until the other side had them all"""
+    done = threading.Event()
+    window = threading.Semaphore(WINDOW)
+    received = [0]
+
+    def on_message(data):
+        received[0] += 1
+        if received[0] == MESSAGES:
+            done.set()
+
+    receiver = socketio.Client()
+    receiver.on('new_message', on_message)
+    sender = socketio.Client()
+    sender.on('message_sent', lambda data: window.release())
+    for client, token in ((receiver, receiver_token), (sender, sender_token)):
+        client.connect(f'http://127.0.0.1:{port}', transports=['websocket'], auth={'token': token})
+    barrier.wait()  # Every pair connected
+    barrier.wait()  # And the workers heard of every session
+
+    started = time.perf_counter()
+    for i in range(MESSAGES):
+        window.acquire()
+        sender.emit('send_message', {'chat_id': chat_id, 'message': f'message {i}'})
+    done.wait(120)
+    results.put((received[0], time.perf_counter() - started))
+    sender.disconnect()
+    receiver.disconnect()
+
+
+def main():
+    data_dir = tempfile.mkdtemp(prefix='nvda-chat-bench-')
+    try:
+        # Users and chats are registered once; the server's signing key is
+        # fixed, so the tokens stay valid across the restarts below
+        port = free_port()
+        processes = start_cluster(1, data_dir, port)
+        pairs = []
+        try:
+            for i in range(PAIRS):
+                sender = post(port, '/api/auth/register', {'username': f'sender{i}', 'password': 'pw'})
+                receiver = post(port, '/api/auth/register', {'username': f'receiver{i}', 'password': 'pw'})
+                chat_id = post(port, '/api/chats/create',
+                               {'type': 'private', 'participants': [f'receiver{i}']}, sender['token'])['chat_id']
+                pairs.append((sender['token'], receiver['token'], chat_id))
+        finally:
+            stop_cluster(processes)
+
+        print(f"CPUs: {os.cpu_count()} (the rate cannot grow past that many workers)")
+        print(f"{'workers':>8} {'delivered':>10} {'seconds':>8} {'messages/s':>11}")
+        for workers in WORKER_COUNTS:
+            port = free_port()
+            processes = start_cluster(workers, data_dir, port)
+            try:
+                barrier = multiprocessing.Barrier(PAIRS + 1)
+                results = multiprocessing.Queue()
+                clients = [
+                    multiprocessing.Process(target=run_pair, args=(port, *pair, barrier, results))
+                    for pair in pairs
+                ]
+                for client in clients:
+                    client.start()
+                barrier.wait()
+                time.sleep(1)  # Session announcements reach every worker before the clock starts
+                barrier.wait()
+                outcomes = [results.get() for _ in clients]
+                for client in clients:
+                    client.join()
+            finally:
+                stop_cluster(processes)
+            delivered = sum(received for received, _ in outcomes)
+            seconds = max(elapsed for _, elapsed in outcomes)
+            print(f"{workers:>8} {delivered:>10} {seconds:>8.2f} {delivered / seconds:>11.0f}")
+    finally:
+        shutil.rmtree(data_dir, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Benchmark: GET /api/friends throughput with the access token cache on and off.
+
+Users with 50 accepted friends each call /api/friends through the Flask
+test client. With the cache on, every call after a user's first skips
+the JWT signature check; with TOKEN_CACHE_SIZE = 0 every call pays for it.
+
+    python benchmarks/bench_friends.py
+"""
+
+import time
+
+from harness import USER_RECORD, percentiles, server
+
+USERS = 200
+FRIENDS = 50
+REQUESTS = 5000
+
+
+def add_users():
+    usernames = [f'user{i}' for i in range(USERS)]
+    for i, username in enumerate(usernames):
+        server.user_index.add(username, USER_RECORD)
+        friends = {usernames[(i + j) % USERS]: 'accepted' for j in range(1, FRIENDS + 1)}
+        server.storage.save_friends(username, friends)
+    return usernames
+
+
+def main():
+    usernames = add_users()
+    headers = [{'Authorization': f'Bearer {server.create_token(username)}'} for username in usernames]
+    client = server.app.test_client()
+
+    print(f"{'token cache':>12} {'requests/s':>11} {'median':>10} {'p99':>10} {'hit rate':>9}")
+    for cache_size in (server.TOKEN_CACHE_SIZE, 0):
+        server.token_cache = server.TokenCache(cache_size)
+        hits, misses = server.metrics['token_cache_hits'], server.metrics['token_cache_misses']
+        timings = []
+        started = time.perf_counter()
+        for i in range(REQUESTS):
+            request_started = time.perf_counter()
+            response = client.get('/api/friends', headers=headers[i % USERS])
+            timings.append(time.perf_counter() - request_started)
+            assert response.status_code == 200
+        elapsed = time.perf_counter() - started
+        hits = server.metrics['token_cache_hits'] - hits
+        misses = server.metrics['token_cache_misses'] - misses
+        median, p99 = percentiles(timings)
+        print(f"{'on' if cache_size else 'off':>12} {REQUESTS / elapsed:>11.0f} "
+              f"{median * 1e6:>8.0f}us {p99 * 1e6:>8.0f}us {hits / (hits + misses):>8.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Benchmark: sending to groups of 10, 100, 1,000 and 10,000 online members.
+
+Connects one Socket.IO test client per member. Socket writes are replaced by a
+no-op after connecting, so the fanout time is the server's own work
+(room lookup, encoding, handing the frame to each session). The send ack
+should stay flat; fanout grows with the number of sessions but the packet
+is encoded once per message.
+
+    python benchmarks/bench_group_fanout.py
+"""
+
+import time
+
+from harness import connect_users, percentiles, server
+
+GROUP_SIZES = [10, 100, 1000, 10000]
+MESSAGES = 200
+
+
+def create_group(size):
+    chat_id = server.ids.new('chat')
+    members = [f'member{i}' for i in range(size)]
+    server.chat_registry.add(chat_id, {
+        'type': 'group', 'name': f'group {size}', 'participants': members,
+        'created_by': members[0], 'admin': members[0]
+    })
+    with server.app.app_context():
+        for member in members:
+            server.join_chat_room(member, chat_id)
+    return chat_id
+
+
+def main():
+    clients = connect_users([f'member{i}' for i in range(max(GROUP_SIZES))])
+    sender = clients[0]
+    server.socketio.server._send_eio_packet = lambda eio_sid, eio_pkt: None
+
+    print(f"{'members':>8} {'ack median':>11} {'fanout median':>14} {'p99':>10} {'encodes/msg':>12}")
+    for size in GROUP_SIZES:
+        chat_id = create_group(size)
+        acks = []
+        fanouts = []
+        encodes_before = server.metrics['message_encodes']
+        for i in range(MESSAGES):
+            started = time.perf_counter()
+            sender.emit('send_message', {'chat_id': chat_id, 'message': f'message {i}'})
+            acks.append(time.perf_counter() - started)
+            # Deliver inline, as a fanout worker would
+            queued_chat_id, payload, _ = server.fanout_queue_for(chat_id).get()
+            started = time.perf_counter()
+            server.deliver_message(queued_chat_id, payload)
+            fanouts.append(time.perf_counter() - started)
+        encodes = (server.metrics['message_encodes'] - encodes_before) / MESSAGES
+        fanout_median, fanout_p99 = percentiles(fanouts)
+        print(f"{size:>8} {percentiles(acks)[0] * 1e6:>9.0f}us "
+              f"{fanout_median * 1e3:>12.2f}ms {fanout_p99 * 1e3:>8.2f}ms {encodes:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Benchmark: login and registration cost with 10k, 100k and 1M users.
+
+Fills the credential index with users. Passwords are hashed with the
+cheapest bcrypt cost so the index and storage work is what gets measured.
+Latency should not depend on the number of users.
+
+    python benchmarks/bench_login.py
+"""
+
+import random
+import time
+
+import bcrypt
+
+from harness import percentiles, server
+
+USER_COUNTS = [10000, 100000, 1000000]
+LOGINS = 500
+REGISTRATIONS = 500
+
+
+def main():
+    record = {
+        'password': bcrypt.hashpw(b'secret', bcrypt.gensalt(4)).decode('utf-8'),
+        'created_at': '2026-01-01T00:00:00'
+    }
+    client = server.app.test_client()
+    rng = random.Random(1)
+
+    filled = 0
+    print(f"{'users':>8} {'login median':>13} {'p99':>10} {'register median':>16} {'p99':>10}")
+    for count in USER_COUNTS:
+        # Bulk fill in memory; only the timed registrations go through storage
+        for i in range(filled, count):
+            server.user_index.users[f'user{i}'] = record
+        filled = count
+
+        logins = []
+        for _ in range(LOGINS):
+            username = f'user{rng.randrange(count)}'
+            started = time.perf_counter()
+            response = client.post('/api/auth/login', json={'username': username, 'password': 'secret'})
+            logins.append(time.perf_counter() - started)
+            assert response.status_code == 200
+
+        registrations = []
+        for i in range(REGISTRATIONS):
+            started = time.perf_counter()
+            assert server.user_index.add(f'new{count}_{i}', record)
+            registrations.append(time.perf_counter() - started)
+
+        login_median, login_p99 = percentiles(logins)
+        register_median, register_p99 = percentiles(registrations)
+        print(f"{count:>8} {'%.0fus' % (login_median * 1e6):>13} {'%.0fus' % (login_p99 * 1e6):>10} "
+              f"{'%.0fus' % (register_median * 1e6):>16} {'%.0fus' % (register_p99 * 1e6):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Benchmark: handing over a mailbox of 100, 1,000 and 10,000 missed messages.
+
+Queues messages from 50 chats for one offline user, then times the drain
+(reading and sorting the segments), the acknowledgement (deleting them) and
+the whole missed_messages delivery to a connected session. Drain and
+delivery should grow linearly with the number of messages.
+
+    python benchmarks/bench_mailbox.py
+"""
+
+import time
+
+from harness import USER_RECORD, connect_users, percentiles, server
+
+MAILBOX_SIZES = [100, 1000, 10000]
+CHATS = 50
+RUNS = 5
+
+
+def fill_mailbox(username, count):
+    entries = [{
+        'chat_id': f'chat_{i % CHATS}',
+        'message': {'id': f'msg_{i}', 'sender': 'friend', 'message': f'message {i}', 'seq': i // CHATS + 1},
+        'queued_at': time.time()
+    } for i in range(count)]
+    # One append per message, as the fanout workers write them
+    for entry in entries:
+        server.mailboxes.append_many([username], [entry])
+
+
+def main():
+    server.user_index.add('reader', USER_RECORD)
+    [client] = connect_users(['reader'])
+    sid = next(iter(server.online_users['reader']))
+
+    print(f"{'messages':>8} {'drain':>10} {'ack':>10} {'deliver':>10} {'p99':>10}")
+    for count in MAILBOX_SIZES:
+        drains, acks, deliveries = [], [], []
+        for _ in range(RUNS):
+            fill_mailbox('away', count)
+            started = time.perf_counter()
+            entries, claimed = server.mailboxes.drain('away')
+            drains.append(time.perf_counter() - started)
+            assert len(entries) == count
+            started = time.perf_counter()
+            server.mailboxes.acknowledge('away', claimed)
+            acks.append(time.perf_counter() - started)
+
+            fill_mailbox('reader', count)
+            started = time.perf_counter()
+            server.deliver_mailbox('reader', sid)
+            deliveries.append(time.perf_counter() - started)
+            [batch] = [packet for packet in client.get_received() if packet['name'] == 'missed_messages']
+            assert len(batch['args'][0]['messages']) == count
+            server.mailboxes.acknowledge('reader', server.mailboxes.drain('reader')[1])
+        print(f"{count:>8} {percentiles(drains)[0] * 1e3:>8.1f}ms {percentiles(acks)[0] * 1e3:>8.2f}ms "
+              f"{percentiles(deliveries)[0] * 1e3:>8.1f}ms {percentiles(deliveries)[1] * 1e3:>8.1f}ms")
+    client.disconnect()
+
+
+if __name__ == '__main__':
+    main()
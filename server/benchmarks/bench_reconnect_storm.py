@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark: CPU cost of a reconnect storm, password logins vs refresh tokens.
+
+Every client reconnects at once (for example after a server restart), either
+logging in again with its password (a bcrypt check at the server's cost
+factor) or trading its refresh token. Wall time and process CPU time cover
+the whole storm, including the I/O threads bcrypt runs on. Refreshing
+should cost a small fraction of the CPU.
+
+    python benchmarks/bench_reconnect_storm.py
+"""
+
+import time
+
+import bcrypt
+import eventlet
+
+from harness import percentiles, server
+
+CLIENTS = 100
+CONCURRENCY = 50
+
+
+def storm(requests):
+    """Run the requests concurrently: (wall seconds, CPU seconds, latencies)"""
+    def timed(request):
+        started = time.perf_counter()
+        response = request()
+        assert response.status_code == 200, response.get_json()
+        return time.perf_counter() - started
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    latencies = list(eventlet.GreenPool(CONCURRENCY).imap(timed, requests))
+    return time.perf_counter() - wall, time.process_time() - cpu, latencies
+
+
+def main():
+    record = {
+        'password': bcrypt.hashpw(b'secret', bcrypt.gensalt()).decode('utf-8'),
+        'created_at': '2026-01-01T00:00:00'
+    }
+    usernames = [f'user{i}' for i in range(CLIENTS)]
+    for username in usernames:
+        server.user_index.users[username] = record
+    client = server.app.test_client()
+    refresh_tokens = {username: server.refresh_tokens.issue(username) for username in usernames}
+
+    def login(username):
+        return lambda: client.post('/api/auth/login', json={'username': username, 'password': 'secret'})
+
+    def refresh(username):
+        def request():
+            response = client.post('/api/auth/refresh', json={'refresh_token': refresh_tokens[username]})
+            refresh_tokens[username] = response.get_json()['refresh_token']
+            return response
+        return request
+
+    print(f"{'reconnect':>10} {'clients':>8} {'wall':>9} {'cpu':>9} {'cpu/client':>11} {'p99':>10}")
+    for name, make in (('password', login), ('refresh', refresh)):
+        wall, cpu, latencies = storm([make(username) for username in usernames])
+        print(f"{name:>10} {CLIENTS:>8} {wall:>8.2f}s {cpu:>8.2f}s "
+              f"{cpu / CLIENTS * 1e3:>9.2f}ms {percentiles(latencies)[1] * 1e3:>8.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
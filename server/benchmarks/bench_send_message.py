@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Benchmark: send_message latency as the number of chats on the server grows.
+
+Fills the chat registry (and chats.json) with private chats and times the
+send_message handler for one of them. Latency should stay flat.
+
+    python benchmarks/bench_send_message.py
+"""
+
+import os
+import time
+
+from harness import USER_RECORD, connect_users, percentiles, server
+
+CHAT_COUNTS = [1000, 10000, 100000]
+MESSAGES = 2000
+
+
+def add_chats(start, end):
+    for i in range(start, end):
+        server.chat_registry.add(server.ids.new('chat'), {
+            'type': 'private',
+            'name': '',
+            'participants': [f'user{i}', f'user{i + 1}'],
+            'created_at': '2026-01-01T00:00:00',
+            'created_by': f'user{i}',
+            'admin': None
+        })
+    server.chat_registry.flush()
+    server.storage.compact()
+
+
+def main():
+    for username in ('alice', 'bob'):
+        server.user_index.add(username, USER_RECORD)
+    chat_id = server.ids.new('chat')
+    server.chat_registry.add(chat_id, {
+        'type': 'private', 'name': '', 'participants': ['alice', 'bob'],
+        'created_by': 'alice', 'admin': None
+    })
+    [client] = connect_users(['alice'])
+
+    print(f"{'chats':>8} {'chats.json':>12} {'median':>10} {'p99':>10}")
+    added = 0
+    for count in CHAT_COUNTS:
+        add_chats(added, count)
+        added = count
+        timings = []
+        for i in range(MESSAGES):
+            started = time.perf_counter()
+            client.emit('send_message', {'chat_id': chat_id, 'message': f'message {i}'})
+            timings.append(time.perf_counter() - started)
+            # Deliver inline, as a fanout worker would, outside the timing
+            while not server.fanout_queue_for(chat_id).empty():
+                queued_chat_id, payload, _ = server.fanout_queue_for(chat_id).get()
+                server.deliver_message(queued_chat_id, payload)
+            client.get_received()
+        median, p99 = percentiles(timings)
+        size = os.path.getsize(server.CHATS_FILE) if os.path.exists(server.CHATS_FILE) else 0
+        print(f"{count:>8} {size / 1e6:>10.1f}MB {median * 1e6:>8.0f}us {p99 * 1e6:>8.0f}us")
+    client.disconnect()
+
+
+if __name__ == '__main__':
+    main()
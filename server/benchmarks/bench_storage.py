@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark: register, login, add_friend and create_chat with 100,000 users,
+on the JSON and the SQLite storage backend.
+
+Runs itself once per backend (the backend is picked when the server module
+is imported), fills the backend with users in bulk and times each endpoint
+through the Flask test client. Passwords are hashed with the cheapest bcrypt
+cost so the storage work is what gets measured.
+
+    python benchmarks/bench_storage.py
+"""
+
+import functools
+import os
+import random
+import subprocess
+import sys
+import time
+
+USERS = 100000
+CALLS = 500
+BACKENDS = ['json', 'sqlite']
+
+
+def run_backend():
+    import bcrypt
+    from harness import percentiles, server
+
+    bcrypt_gensalt = bcrypt.gensalt
+    server.bcrypt.gensalt = functools.partial(bcrypt_gensalt, 4)
+    record = {
+        'password': bcrypt.hashpw(b'secret', bcrypt_gensalt(4)).decode('utf-8'),
+        'created_at': '2026-01-01T00:00:00'
+    }
+    users = {f'user{i}': record for i in range(USERS)}
+    if isinstance(server.storage, server.SqliteStorage):
+        with server.storage.db:
+            server.storage.db.executemany(
+                'INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)',
+                [(username, record['password'], record['created_at']) for username in users]
+            )
+    else:
+        server.save_json(server.USERS_INDEX_FILE, users)
+    server.user_index.load()
+
+    client = server.app.test_client()
+    rng = random.Random(3)
+
+    def auth(username):
+        return {'Authorization': f'Bearer {server.create_token(username)}'}
+
+    def timed(requests):
+        timings = []
+        for request in requests:
+            started = time.perf_counter()
+            response = request()
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.get_json()
+        return percentiles(timings)
+
+    pairs = [rng.sample(range(USERS), 2) for _ in range(CALLS)]
+    results = {
+        'register': timed([
+            functools.partial(client.post, '/api/auth/register', json={'username': f'new{i}', 'password': 'secret'})
+            for i in range(CALLS)
+        ]),
+        'login': timed([
+            functools.partial(client.post, '/api/auth/login', json={'username': f'user{a}', 'password': 'secret'})
+            for a, _ in pairs
+        ]),
+        'add_friend': timed([
+            functools.partial(client.post, '/api/friends/add', json={'username': f'user{b}'}, headers=auth(f'user{a}'))
+            for a, b in pairs
+        ]),
+        'create_chat': timed([
+            functools.partial(client.post, '/api/chats/create', json={'type': 'private', 'participants': [f'user{b}']},
+                              headers=auth(f'user{a}'))
+            for a, b in pairs
+        ]),
+    }
+    for operation, (median, p99) in results.items():
+        print(f"{server.STORAGE_BACKEND:>8} {operation:>12} {median * 1e6:>8.0f}us {p99 * 1e6:>8.0f}us", flush=True)
+
+
+def main():
+    print(f"{'backend':>8} {'operation':>12} {'median':>10} {'p99':>10}", flush=True)
+    for backend in BACKENDS:
+        subprocess.run([sys.executable, os.path.abspath(__file__), backend], check=True,
+                       env=dict(os.environ, NVDA_CHAT_STORAGE=backend))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_backend()
+    else:
+        main()
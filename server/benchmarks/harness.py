@@ -0,0 +1,46 @@
+"""
+Shared setup for the benchmark scripts.
+
+Importing this module points the server at a temporary data directory
+(removed at exit) and imports it in-process, so every benchmark measures
+the same code the server runs without touching real data.
+"""
+
+import atexit
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+
+DATA_DIR = tempfile.mkdtemp(prefix='nvda-chat-bench-')
+os.environ['NVDA_CHAT_DATA'] = DATA_DIR
+atexit.register(shutil.rmtree, DATA_DIR, True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+USER_RECORD = {'password': '', 'created_at': '2026-01-01T00:00:00'}
+
+
+def percentiles(timings):
+    """Median and p99 of a list of durations, in seconds"""
+    timings = sorted(timings)
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+def connect_users(usernames):
+    """One authenticated Socket.IO test client per user, welcome events read"""
+    clients = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for username in usernames:
+            server.user_index.users.setdefault(username, USER_RECORD)
+            clients.append(server.socketio.test_client(
+                server.app, auth={'token': server.create_token(username)}
+            ))
+        server.socketio.sleep(min(1, 0.1 + len(usernames) / 10000))  # let the welcome tasks finish
+    for client in clients:
+        client.get_received()
+    return clients
@@ -5,15 +5,174 @@ Version 2.0 - Privacy-focused, organized data storage
 """
 
 from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
+from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect, ConnectionRefusedError
 from flask_cors import CORS
+from socketio import PubSubManager, RedisManager, KombuManager
+from socketio.packet import Packet, EVENT
+from engineio.packet import Packet as EnginePacket, MESSAGE
 import os
 import json
+import struct
+import subprocess
 import bcrypt
 import jwt
 import time
+import atexit
+import sqlite3
+import shutil
+import sys
+import threading
+import hashlib
+import secrets
+import zlib
+from collections import deque, OrderedDict
 from datetime import datetime, timedelta
 from functools import wraps
+import eventlet
+import eventlet.wsgi
+from eventlet import tpool
+from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+from eventlet.queue import Queue
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not on Windows; only needed by cluster workers
+
+class CountingPacket(Packet):
+    """Socket.IO packet that counts how many times payloads get encoded"""
+    encode_count = 0
+    
+    def encode(self):
+        CountingPacket.encode_count += 1
+        return super().encode()
+
+# Listening port (NVDA_CHAT_PORT overrides it)
+PORT = int(os.environ.get('NVDA_CHAT_PORT', 8080))
+
+# Multi-process mode: CLUSTER_WORKERS processes share PORT (through
+# SO_REUSEPORT, so clients must use the websocket transport) and exchange
+# Socket.IO traffic and shared state over CLUSTER_BUS. A unix:// path is
+# served by a broker in the parent process; redis:// or amqp:// URLs use
+# Socket.IO's Redis / Kombu managers (which need eventlet.monkey_patch()).
+# Workers need the sqlite storage backend. NVDA_CHAT_WORKERS and
+# NVDA_CHAT_BUS override both settings.
+CLUSTER_WORKERS = int(os.environ.get('NVDA_CHAT_WORKERS', 1))
+CLUSTER_BUS = os.environ.get('NVDA_CHAT_BUS', 'unix:///tmp/nvda_chat_bus.sock')
+CLUSTER_HEARTBEAT = 2
+
+# Index of this process when started by the cluster parent as
+# 'server.py worker <n>', None when running on its own
+CLUSTER_NODE = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[1] == 'worker' else None
+
+def send_frame(sock, payload):
+    sock.sendall(struct.pack('>I', len(payload)) + payload)
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Bus connection closed')
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    size, = struct.unpack('>I', recv_exactly(sock, 4))
+    return recv_exactly(sock, size)
+
+class ClusterEvents:
+    """Mixin for Socket.IO pub/sub managers: also carries this server's own
+    cluster events over the same channel, in order with the emits"""
+    
+    def publish_event(self, event, data):
+        self._publish({'method': 'cluster', 'host_id': self.host_id, 'event': event, 'data': data})
+    
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if isinstance(message, (bytes, str)):
+                try:
+                    data = self.json.loads(message)
+                except ValueError:
+                    pass
+            if isinstance(data, dict) and data.get('method') == 'cluster':
+                if data.get('host_id') != self.host_id:
+                    try:
+                        handle_cluster_event(data['event'], data['data'])
+                    except Exception as e:
+                        print(f"Error handling cluster event {data['event']}: {e}")
+                continue
+            yield message
+
+class UnixSocketPubSub(PubSubManager):
+    """Pub/sub through the cluster parent's broker (run_bus_broker), so
+    workers on one machine need no external service"""
+    
+    name = 'unix'
+    
+    def __init__(self, url, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('unix://'):]
+        self.publisher = None
+        self.publish_lock = Semaphore()
+    
+    def _connect(self, role):
+        """Connect to the broker as a publisher (b'P') or subscriber (b'S')"""
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                sock.sendall(role)
+                return sock
+            except OSError:
+                sock.close()
+                eventlet.sleep(1)
+    
+    def _publish(self, data):
+        # Same JSON encoding as the Redis / Kombu managers, which is what
+        # PubSubManager._thread decodes
+        payload = self.json.dumps(data).encode('utf-8')
+        with self.publish_lock:
+            for _ in range(2):
+                if self.publisher is None:
+                    self.publisher = self._connect(b'P')
+                try:
+                    send_frame(self.publisher, payload)
+                    return
+                except OSError:
+                    self.publisher.close()
+                    self.publisher = None
+    
+    def _listen(self):
+        while True:
+            sock = self._connect(b'S')
+            try:
+                while True:
+                    yield recv_frame(sock)
+            except OSError:
+                sock.close()
+
+class UnixSocketManager(ClusterEvents, UnixSocketPubSub):
+    """ClusterEvents comes first in the MRO so that its _listen wraps the
+    transport's _listen instead of being overridden by it"""
+
+class RedisClusterManager(ClusterEvents, RedisManager):
+    pass
+
+class KombuClusterManager(ClusterEvents, KombuManager):
+    pass
+
+def create_client_manager(url):
+    """Socket.IO client manager for a cluster worker, None when running alone"""
+    if CLUSTER_NODE is None:
+        return None
+    if url.startswith('unix://'):
+        return UnixSocketManager(url)
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisClusterManager(url)
+    return KombuClusterManager(url)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this-in-production'
@@ -24,94 +183,1743 @@ socketio = SocketIO(
     async_mode='eventlet',
     ping_interval=25,
     ping_timeout=60,
+    serializer=CountingPacket,
+    client_manager=create_client_manager(CLUSTER_BUS),
     logger=False,
     engineio_logger=False
 )
 
-# Paths - New Structure
-DATA_PATH = '/home/metal/nvda-chat-server/data'
-USERS_DIR = os.path.join(DATA_PATH, 'users')
+# Paths - New Structure (NVDA_CHAT_DATA overrides the data directory)
+DATA_PATH = os.environ.get('NVDA_CHAT_DATA', '/home/metal/nvda-chat-server/data')
+USERS_DIR = os.path.join(DATA_PATH, 'users')  # Legacy flat layout: users/<username>
+USER_SHARDS_DIR = os.path.join(DATA_PATH, 'user_shards')  # user_shards/ab/cd/<username>
 USERS_INDEX_FILE = os.path.join(DATA_PATH, 'users_index.json')
+USERS_LOG_FILE = os.path.join(DATA_PATH, 'users_index.log')
 CHATS_FILE = os.path.join(DATA_PATH, 'chats.json')
+SQLITE_FILE = os.path.join(DATA_PATH, 'nvda_chat.db')
+JOURNAL_FILE = os.path.join(DATA_PATH, 'journal.log')
+MAILBOX_DIR = os.path.join(DATA_PATH, 'mailboxes')
+REFRESH_TOKENS_FILE = os.path.join(DATA_PATH, 'refresh_tokens.json')
+
+# Storage backend: 'json' (users_index.json, chats.json, user folders) or
+# 'sqlite' (NVDA_CHAT_STORAGE overrides it)
+STORAGE_BACKEND = os.environ.get('NVDA_CHAT_STORAGE', 'json')
+
+# Seconds between write-behind flushes of the in-memory chat registry
+CHATS_FLUSH_INTERVAL = 2
+
+# JSON backend journal: fsync once per commit interval, and fold the journal
+# into chats.json / friends.json snapshots every compact interval or size
+JOURNAL_COMMIT_INTERVAL = 0.2
+JOURNAL_COMPACT_INTERVAL = 300
+JOURNAL_COMPACT_BYTES = 16 * 1024 * 1024
+
+# Login hands out a short-lived access JWT plus a long-lived refresh token;
+# clients trade the refresh token for new access tokens instead of sending
+# the password (and paying for a bcrypt check) on every reconnect
+ACCESS_TOKEN_TTL = 3600
+REFRESH_TOKEN_TTL = 30 * 24 * 3600
+
+# Sockets present their access token in the Socket.IO CONNECT packet
+# ({"token": ...}) and are refused without one. Set to False to also admit
+# older clients that connect first and send an 'authenticate' event.
+REQUIRE_HANDSHAKE_AUTH = True
+
+# Verified access tokens are cached by digest, so REST calls and connects
+# skip the JWT signature check; entries expire along with the token.
+# 0 turns the cache off (revoked tokens are still rejected).
+TOKEN_CACHE_SIZE = 10000
+
+# Connection budget (per worker), counted in Engine.IO sockets so it also
+# covers sockets that never send a Socket.IO CONNECT: at most MAX_CONNECTIONS
+# sockets, MAX_CONNECTIONS_PER_IP from one address, and sockets still
+# unauthenticated after AUTH_DEADLINE seconds are closed
+MAX_CONNECTIONS = 20000
+MAX_CONNECTIONS_PER_IP = 50
+AUTH_DEADLINE = 10
+
+# Typing indicators are sent at most once per window for each (user, chat)
+TYPING_WINDOW = 3
+
+# Chat messages are acknowledged right away and delivered by background
+# workers; rooms larger than the chunk size are sent in chunks of sessions.
+# Each chat always goes to the same worker, so its messages stay in order.
+FANOUT_WORKERS = 4
+FANOUT_QUEUE_SIZE = 10000  # Split evenly between the workers' queues
+FANOUT_CHUNK_SIZE = 500
+
+# Presence: a user is only announced offline after a grace period (a quick
+# reconnect cancels it), and changes are sent to each friend as one
+# presence_batch event per interval
+PRESENCE_OFFLINE_GRACE = 10
+PRESENCE_BATCH_INTERVAL = 2
+
+# Outbound priorities per session, by packets waiting in its send queue:
+# typing is dropped past the first limit, presence is coalesced past the
+# second, and a session above the last one for SLOW_CONSUMER_GRACE seconds
+# is disconnected. Chat messages and group/admin events are always queued.
+OUTBOUND_TYPING_LIMIT = 50
+OUTBOUND_PRESENCE_LIMIT = 200
+OUTBOUND_SESSION_LIMIT = 1000
+SLOW_CONSUMER_GRACE = 30
+OUTBOUND_CHECK_INTERVAL = 1
+
+# Messages for users with no connected session are kept in an on-disk
+# mailbox until they connect, for at most MAILBOX_TTL seconds and
+# MAILBOX_MAX_BYTES per user (oldest segments are dropped first)
+MAILBOX_TTL = 7 * 24 * 3600
+MAILBOX_MAX_BYTES = 4 * 1024 * 1024
+MAILBOX_SEGMENT_BYTES = 256 * 1024
+MAILBOX_CLEANUP_INTERVAL = 3600
+
+# Every chat message gets a per-chat sequence number. The last
+# RECENT_MESSAGES_PER_CHAT messages of each chat are kept in memory only,
+# so reconnecting clients can ask for what they missed. Counters are
+# persisted write-behind, so after a restart they jump ahead by
+# SEQ_RESTART_GAP to stay monotonic even if the last flush was lost.
+RECENT_MESSAGES_PER_CHAT = 200
+SEQ_RESTART_GAP = 1000
+
+# Message and chat ids are Snowflake-style: milliseconds since the Unix
+# epoch, then a node id, then a per-millisecond counter, so they are unique
+# and sort by creation time. Every process sharing the data needs its own
+# NODE_ID (0-1023); None uses the cluster worker index, or derives one from
+# the process id when running alone.
+NODE_ID = None
+ID_NODE_BITS = 10
+ID_COUNTER_BITS = 12
+
+# Number of lock stripes for per-chat / per-user mutations
+LOCK_STRIPES = 256
+
+# Move user folders from users/ into user_shards/ in the background while
+# serving, a batch at a time
+MIGRATE_USER_DIRS = True
+USER_DIRS_MIGRATION_BATCH = 100
+USER_DIRS_MIGRATION_PAUSE = 1
+
+# Native threads used for bcrypt and storage I/O so they don't block the
+# eventlet hub (0 runs everything inline on the hub)
+IO_THREADS = 8
+tpool.set_num_threads(IO_THREADS)
 
 # Create directories
 os.makedirs(DATA_PATH, exist_ok=True)
-os.makedirs(USERS_DIR, exist_ok=True)
+os.makedirs(USER_SHARDS_DIR, exist_ok=True)
 
 # In-memory storage for online users
-online_users = {}  # {username: sid}
+online_users = {}  # {username: set(sids)}, one sid per connected device
 user_sessions = {}  # {sid: username}
+typing_windows = {}  # {(username, chat_id): typed again during current window}
+
+# Counters exposed on /api/metrics
+metrics = {
+    'messages_sent': 0,
+    'message_encodes': 0,  # Socket.IO packet encodes spent on message fanout
+    'last_encodes_per_message': 0,
+    'max_encodes_per_message': 0,
+    'fanout_lag_last': 0.0,  # Seconds a message waited in the fanout queue
+    'fanout_lag_max': 0.0,
+    'outbound_queue_depth_total': 0,  # Packets waiting across all sessions
+    'outbound_queue_depth_max': 0,
+    'saturated_sessions': 0,
+    'typing_dropped': 0,
+    'presence_coalesced': 0,
+    'slow_consumers_disconnected': 0,
+    'token_cache_hits': 0,
+    'token_cache_misses': 0,
+    'connections_over_budget': 0,  # Refused by the global or per-IP cap
+    'connections_unauthenticated': 0,  # Refused for a missing or bad token
+    'connections_reaped': 0  # Closed for missing the auth deadline
+}
+
+offline_pending = {}  # {username: time their last session disconnected}
+presence_updates = {}  # {recipient: {username: 'online' / 'offline'}}
+presence_versions = {}  # {recipient: number of the last presence_batch sent}
+pending_presence = {}  # {sid: coalesced presence_batch} held for backed-up sessions
+saturated_since = {}  # {sid: time the session went over OUTBOUND_SESSION_LIMIT}
+typing_backlogged = set()  # sids over OUTBOUND_TYPING_LIMIT at the last outbound check
+connections = {}  # {eio_sid: (remote address, connected_at)} for every open Engine.IO socket
+connections_per_ip = {}  # {remote address: number of open sockets}
+
+fanout_queues = [Queue(FANOUT_QUEUE_SIZE // FANOUT_WORKERS) for _ in range(FANOUT_WORKERS)]  # (chat_id, payload, queued_at)
 
 # Helper Functions
+class UserDirectories:
+    """Resolves user folders, hashed into user_shards/ab/cd/<username> so no
+    single directory holds every user. Folders still in the legacy users/
+    layout are used in place until migrate() moves them."""
+    
+    def __init__(self, legacy_root, root):
+        self.legacy_root = legacy_root
+        self.root = root
+        self.paths = {}  # {username: resolved folder}
+        # Held while reading/writing a user's files so a move can't race them
+        self.stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+    
+    def lock(self, username):
+        return self.stripes[hash(username) % len(self.stripes)]
+    
+    def sharded_path(self, username):
+        digest = hashlib.md5(username.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], username)
+    
+    def resolve(self, username):
+        """Folder for the user; only creates it the first time it is seen"""
+        path = self.paths.get(username)
+        if path is None:
+            path = self.sharded_path(username)
+            legacy_path = os.path.join(self.legacy_root, username)
+            if not os.path.isdir(path) and os.path.isdir(legacy_path):
+                path = legacy_path
+            else:
+                os.makedirs(path, exist_ok=True)
+            self.paths[username] = path
+        return path
+    
+    def list_users(self):
+        users = set(self.legacy_users())
+        for first in os.listdir(self.root):
+            first_dir = os.path.join(self.root, first)
+            for second in os.listdir(first_dir):
+                users.update(os.listdir(os.path.join(first_dir, second)))
+        return sorted(users)
+    
+    def legacy_users(self, limit=None):
+        if not os.path.isdir(self.legacy_root):
+            return []
+        users = []
+        with os.scandir(self.legacy_root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    users.append(entry.name)
+                    if limit is not None and len(users) >= limit:
+                        break
+        return users
+    
+    def migrate(self, username):
+        """Move one user's folder from the legacy layout into its shard"""
+        with self.lock(username):
+            legacy_path = os.path.join(self.legacy_root, username)
+            target = self.sharded_path(username)
+            if not os.path.isdir(legacy_path):
+                return False
+            if os.path.exists(target):
+                print(f"Not migrating {username}: {target} already exists")
+                return False
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(legacy_path, target)
+            self.paths[username] = target
+            return True
+    
+    def run_migration(self):
+        """Background task: move legacy folders over in small batches"""
+        skipped = set()
+        while True:
+            batch = [u for u in run_io(self.legacy_users, USER_DIRS_MIGRATION_BATCH + len(skipped))
+                     if u not in skipped]
+            if not batch:
+                print("User folder migration complete")
+                return
+            for username in batch[:USER_DIRS_MIGRATION_BATCH]:
+                try:
+                    if not run_io(self.migrate, username):
+                        skipped.add(username)
+                except OSError as e:
+                    print(f"Error migrating {username}: {e}")
+                    skipped.add(username)
+            socketio.sleep(USER_DIRS_MIGRATION_PAUSE)
+
+user_dirs = UserDirectories(USERS_DIR, USER_SHARDS_DIR)
+
 def get_user_dir(username):
     """Get or create user-specific directory"""
-    user_dir = os.path.join(USERS_DIR, username)
-    os.makedirs(user_dir, exist_ok=True)
-    return user_dir
+    return user_dirs.resolve(username)
 
 def get_user_file(username, filename):
     """Get path to user-specific file"""
     return os.path.join(get_user_dir(username), filename)
 
+def run_io(func, *args):
+    """Run blocking work (bcrypt, disk I/O) in the native thread pool"""
+    return tpool.execute(func, *args)
+
+class Cluster:
+    """This worker's view of the others: which users have sessions on them,
+    kept current by session events and periodic heartbeats"""
+    
+    def __init__(self, node):
+        self.node = node
+        self.enabled = node is not None
+        self.remote = {}  # {node: set(usernames with a session there)}
+        self.last_seen = {}  # {node: time of its last heartbeat}
+    
+    def owns(self, chat_id):
+        """Chats are spread over the workers; a chat's owner numbers and fans
+        out its messages and persists its message counter"""
+        if not self.enabled:
+            return True
+        digest = hashlib.md5(chat_id.encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) % CLUSTER_WORKERS == self.node
+    
+    def publish(self, event, **data):
+        """Send an event to every other worker (see handle_cluster_event)"""
+        if self.enabled:
+            socketio.server.manager.publish_event(event, data)
+    
+    def remote_online(self, username):
+        """Whether the user has a session on another worker"""
+        return any(username in users for users in self.remote.values())
+    
+    def session_up(self, node, username):
+        self.remote.setdefault(node, set()).add(username)
+    
+    def session_down(self, node, username):
+        self.remote.get(node, set()).discard(username)
+    
+    def heartbeat(self, node, usernames):
+        self.remote[node] = set(usernames)
+        self.last_seen[node] = time.time()
+    
+    def expire(self):
+        """Forget workers that stopped sending heartbeats; returns the users
+        that were only online there"""
+        cutoff = time.time() - 3 * CLUSTER_HEARTBEAT
+        gone = set()
+        for node, seen in list(self.last_seen.items()):
+            if seen < cutoff:
+                del self.last_seen[node]
+                gone |= self.remote.pop(node, set())
+        return [username for username in gone if not is_connected(username)]
+    
+    def run_heartbeat(self):
+        """Background task: tell the others who is online here, and announce
+        the users of workers that went away as offline"""
+        while True:
+            socketio.sleep(CLUSTER_HEARTBEAT)
+            self.publish('sessions', node=self.node, users=list(online_users))
+            for username in self.expire():
+                user_friends = load_user_friends(username)
+                queue_presence(username, 'offline', accepted_friends(user_friends))
+
+cluster = Cluster(CLUSTER_NODE)
+
+class IdAllocator:
+    """Collision-free, time-ordered ids: timestamp | node id | counter"""
+    
+    def __init__(self, node_id):
+        self.node_id = node_id & ((1 << ID_NODE_BITS) - 1)
+        self.lock = threading.Lock()
+        self.last_ms = 0
+        self.counter = 0
+    
+    def next_id(self):
+        with self.lock:
+            now = int(time.time() * 1000)
+            if now > self.last_ms:
+                self.last_ms = now
+                self.counter = 0
+            else:
+                # Same millisecond, or the clock stepped back: keep counting
+                # from the last timestamp handed out so ids never go backwards
+                self.counter += 1
+                if self.counter >> ID_COUNTER_BITS:
+                    self.last_ms += 1
+                    self.counter = 0
+            return (
+                (self.last_ms << (ID_NODE_BITS + ID_COUNTER_BITS))
+                | (self.node_id << ID_COUNTER_BITS)
+                | self.counter
+            )
+    
+    def new(self, prefix):
+        return f"{prefix}_{self.next_id()}"
+
+ids = IdAllocator(
+    NODE_ID if NODE_ID is not None else cluster.node if cluster.enabled else os.getpid()
+)
+
+def _read_json_file(filepath):
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json_file(filepath, data):
+    """Write to a temp file and rename it over the target, so a crash never
+    leaves a truncated file behind"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    temp_path = f"{filepath}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, filepath)
+
 def load_json(filepath, default=None):
     try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        data = run_io(_read_json_file, filepath)
+        if data is not None:
+            return data
     except:
         pass
     return default if default is not None else {}
 
 def save_json(filepath, data):
     try:
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        run_io(_write_json_file, filepath, data)
         return True
     except Exception as e:
         print(f"Error saving {filepath}: {e}")
         return False
 
+# Storage Backends
+
+class Journal:
+    """Append-only log of storage mutations with group-committed fsyncs"""
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = None
+        self.pending = 0  # records written since the last fsync
+    
+    def replay(self):
+        """Read back all complete records and cut off a torn tail"""
+        records = []
+        valid_bytes = 0
+        if os.path.exists(self.filepath):
+            with open(self.filepath, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    valid_bytes += len(line)
+            os.truncate(self.filepath, valid_bytes)
+        return records
+    
+    def open(self):
+        self.file = open(self.filepath, 'a', encoding='utf-8')
+    
+    def append(self, record):
+        # Flushed to the OS right away; fsynced in batches by commit()
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.pending += 1
+    
+    def commit(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+    
+    def size(self):
+        return self.file.tell()
+    
+    def drop_head(self, offset, lock):
+        """Remove the first offset bytes once their records are in the
+        snapshots, keeping whatever was appended after them. The tail is
+        copied and fsynced outside the writers' lock; only records appended
+        during that copy are moved while holding it."""
+        temp_path = self.filepath + '.tmp'
+        with open(self.filepath, 'rb') as source, open(temp_path, 'wb') as f:
+            source.seek(offset)
+            shutil.copyfileobj(source, f)
+            f.flush()
+            os.fsync(f.fileno())
+            with lock:
+                shutil.copyfileobj(source, f)
+                f.flush()
+                self.file.close()
+                os.replace(temp_path, self.filepath)
+                self.open()
+                self.pending = 1  # The records moved last are fsynced by the next commit
+    
+    def close(self):
+        if self.file:
+            self.commit()
+            self.file.close()
+            self.file = None
+
+class JsonStorage:
+    """Original layout: users_index.json, chats.json and one folder per user.
+    
+    Chat and friends changes are appended to a journal and only folded into
+    the JSON snapshots on compaction, so a group operation costs one record
+    instead of a rewrite of chats.json.
+    """
+    
+    def __init__(self):
+        self.journal = Journal(JOURNAL_FILE)
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()  # One compaction at a time
+        self.chats = {}  # Snapshot of chats.json with journaled changes applied
+        self.friends = {}  # {username: friends_data} journaled since compaction
+        self.refresh_tokens = {}  # {token_hash: {'username', 'expires'}}
+        self.last_compact = time.time()
+    
+    def initialize(self):
+        if not os.path.exists(USERS_INDEX_FILE):
+            save_json(USERS_INDEX_FILE, {})
+        
+        # Recover: last snapshot plus whatever the journal recorded after it
+        self.chats = load_json(CHATS_FILE, {})
+        self.refresh_tokens = load_json(REFRESH_TOKENS_FILE, {})
+        for record in self.journal.replay():
+            self.apply(record)
+        self.journal.open()
+        self.compact()
+    
+    def apply(self, record):
+        op = record['op']
+        if op == 'chat_put':
+            self.chats[record['chat_id']] = record['chat']
+        elif op == 'chat_del':
+            self.chats.pop(record['chat_id'], None)
+        elif op == 'seq':
+            for chat_id, last_seq in record['seqs'].items():
+                if chat_id in self.chats:
+                    self.chats[chat_id]['last_seq'] = last_seq
+        elif op == 'friends':
+            self.friends[record['username']] = record['friends']
+        elif op == 'refresh_put':
+            self.refresh_tokens[record['token_hash']] = record['token']
+        elif op == 'refresh_del':
+            self.refresh_tokens.pop(record['token_hash'], None)
+    
+    def write(self, record):
+        self.journal.append(record)
+        self.apply(record)
+    
+    def commit(self):
+        with self.lock:
+            self.journal.commit()
+    
+    def compact(self):
+        """Write fresh snapshots atomically, then drop the journal records
+        they cover. Only the copying holds the storage lock; writes made
+        while the snapshots are saved stay in the journal."""
+        with self.compact_lock:
+            with self.lock:
+                now = time.time()
+                self.refresh_tokens = {
+                    token_hash: token for token_hash, token in self.refresh_tokens.items()
+                    if token['expires'] > now
+                }
+                friends = dict(self.friends)
+                chats = {
+                    chat_id: dict(chat_info, participants=list(chat_info['participants']))
+                    for chat_id, chat_info in self.chats.items()
+                }
+                refresh_tokens = dict(self.refresh_tokens)
+                self.journal.file.flush()
+                covered = self.journal.size()
+            
+            for username, friends_data in friends.items():
+                with user_dirs.lock(username):
+                    if not save_json(get_user_file(username, 'friends.json'), friends_data):
+                        return False
+            if not save_json(CHATS_FILE, chats):
+                return False
+            if not save_json(REFRESH_TOKENS_FILE, refresh_tokens):
+                return False
+            
+            self.journal.drop_head(covered, self.lock)
+            with self.lock:
+                # Friends journaled again meanwhile are newer than their snapshot
+                for username, friends_data in friends.items():
+                    if self.friends.get(username) is friends_data:
+                        del self.friends[username]
+                self.last_compact = time.time()
+            return True
+    
+    def run_maintenance(self):
+        """Background task: group commit and periodic compaction"""
+        while True:
+            socketio.sleep(JOURNAL_COMMIT_INTERVAL)
+            run_io(self.commit)
+            if (time.time() - self.last_compact >= JOURNAL_COMPACT_INTERVAL or
+                    self.journal.size() >= JOURNAL_COMPACT_BYTES):
+                run_io(self.compact)
+    
+    def close(self):
+        self.compact()
+        self.journal.close()
+    
+    def load_users(self):
+        """Load users_index.json and fold in registrations from the append log"""
+        users_index = load_json(USERS_INDEX_FILE, {})
+        if not os.path.exists(USERS_LOG_FILE):
+            return users_index
+        
+        with open(USERS_LOG_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line from a crash mid-append
+                username = entry.pop('username')
+                users_index[username] = entry
+        
+        # Compact the log into the index so it does not grow forever
+        if save_json(USERS_INDEX_FILE, users_index):
+            os.remove(USERS_LOG_FILE)
+        return users_index
+    
+    def get_user(self, username):
+        return self.load_users().get(username)
+    
+    def add_user(self, username, record):
+        """Append one registration instead of rewriting users_index.json"""
+        try:
+            with open(USERS_LOG_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(dict(record, username=username), ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            return True
+        except Exception as e:
+            print(f"Error saving user {username}: {e}")
+            return False
+    
+    def load_profile(self, username):
+        with user_dirs.lock(username):
+            return load_json(get_user_file(username, 'profile.json'), {})
+    
+    def save_profile(self, username, data):
+        with user_dirs.lock(username):
+            return save_json(get_user_file(username, 'profile.json'), data)
+    
+    def list_profiles(self):
+        return user_dirs.list_users()
+    
+    def load_friends(self, username):
+        with self.lock:
+            friends_data = self.friends.get(username)
+            if friends_data is not None:
+                return dict(friends_data)
+        with user_dirs.lock(username):
+            return load_json(get_user_file(username, 'friends.json'), {})
+    
+    def save_friends(self, username, friends_data):
+        try:
+            with self.lock:
+                self.write({'op': 'friends', 'username': username, 'friends': dict(friends_data)})
+            return True
+        except Exception as e:
+            print(f"Error saving friends of {username}: {e}")
+            return False
+    
+    def update_friendship(self, username, friend, change):
+        """Move the pair (username's status for friend, friend's status for
+        username) to change(pair) under the storage lock; None removes a side.
+        Returns (before, after), or None if saving failed."""
+        try:
+            with self.lock:
+                sides = []
+                for owner, other in ((username, friend), (friend, username)):
+                    friends_data = self.friends.get(owner)
+                    if friends_data is None:
+                        with user_dirs.lock(owner):
+                            friends_data = load_json(get_user_file(owner, 'friends.json'), {})
+                    sides.append((owner, other, dict(friends_data)))
+                before = tuple(friends_data.get(other) for _, other, friends_data in sides)
+                after = change(before)
+                for (owner, other, friends_data), old, status in zip(sides, before, after):
+                    if status == old:
+                        continue
+                    if status is None:
+                        del friends_data[other]
+                    else:
+                        friends_data[other] = status
+                    self.write({'op': 'friends', 'username': owner, 'friends': friends_data})
+            return before, after
+        except Exception as e:
+            print(f"Error saving friendship of {username} and {friend}: {e}")
+            return None
+    
+    def load_chats(self):
+        with self.lock:
+            return {
+                chat_id: dict(chat_info, participants=list(chat_info['participants']))
+                for chat_id, chat_info in self.chats.items()
+            }
+    
+    def save_chats(self, changes):
+        """Journal one record per changed chat ({chat_id: chat_info or None})"""
+        try:
+            with self.lock:
+                for chat_id, chat_info in changes.items():
+                    if chat_info is None:
+                        self.write({'op': 'chat_del', 'chat_id': chat_id})
+                    else:
+                        self.write({'op': 'chat_put', 'chat_id': chat_id, 'chat': chat_info})
+            return True
+        except Exception as e:
+            print(f"Error saving chats: {e}")
+            return False
+    
+    def save_seqs(self, seqs):
+        """Journal new message counters ({chat_id: last_seq}) as one record"""
+        try:
+            with self.lock:
+                self.write({'op': 'seq', 'seqs': seqs})
+            return True
+        except Exception as e:
+            print(f"Error saving message counters: {e}")
+            return False
+    
+    def load_refresh_tokens(self):
+        with self.lock:
+            return {token_hash: dict(token) for token_hash, token in self.refresh_tokens.items()}
+    
+    def get_refresh_token(self, token_hash):
+        with self.lock:
+            token = self.refresh_tokens.get(token_hash)
+            return dict(token) if token is not None else None
+    
+    def save_refresh_token(self, token_hash, token):
+        """Journal one refresh token ({'username', 'expires'}), or its removal if None"""
+        try:
+            with self.lock:
+                if token is None:
+                    self.write({'op': 'refresh_del', 'token_hash': token_hash})
+                else:
+                    self.write({'op': 'refresh_put', 'token_hash': token_hash, 'token': token})
+            return True
+        except Exception as e:
+            print(f"Error saving refresh token: {e}")
+            return False
+
+class SqliteStorage:
+    """Single SQLite database in WAL mode with indexed lookup tables"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS profiles (
+            username TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS friends (
+            username TEXT NOT NULL,
+            friend TEXT NOT NULL,
+            status TEXT NOT NULL,
+            PRIMARY KEY (username, friend)
+        );
+        CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends (friend);
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, username)
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_members_username ON chat_members (username);
+        CREATE TABLE IF NOT EXISTS chat_seq (
+            chat_id TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS private_chats (
+            pair TEXT PRIMARY KEY,
+            chat_id TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_private_chats_chat ON private_chats (chat_id);
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+    """
+    
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.local = threading.local()
+    
+    @property
+    def db(self):
+        """One connection per I/O thread; WAL lets readers run beside a writer"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filepath, isolation_level=None, timeout=30)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+    
+    def initialize(self):
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+        # Databases from before private_chats: index the private chats they hold
+        if self.db.execute('SELECT 1 FROM private_chats LIMIT 1').fetchone() is None:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                for chat_id, chat_info in self.load_chats().items():
+                    if chat_info.get('type') == 'private':
+                        self.index_private_chat(chat_id, chat_info)
+    
+    def run_maintenance(self):
+        """SQLite commits and checkpoints on its own"""
+    
+    def close(self):
+        pass
+    
+    def load_users(self):
+        rows = self.db.execute('SELECT username, password, created_at FROM users')
+        return {
+            username: {'password': password, 'created_at': created_at}
+            for username, password, created_at in rows
+        }
+    
+    def get_user(self, username):
+        row = self.db.execute(
+            'SELECT password, created_at FROM users WHERE username = ?', (username,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'password': row[0], 'created_at': row[1]}
+    
+    def add_user(self, username, record):
+        try:
+            self.db.execute(
+                'INSERT INTO users (username, password, created_at) VALUES (?, ?, ?)',
+                (username, record['password'], record.get('created_at'))
+            )
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving user {username}: {e}")
+            return False
+    
+    def load_profile(self, username):
+        row = self.db.execute(
+            'SELECT data FROM profiles WHERE username = ?', (username,)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+    
+    def save_profile(self, username, data):
+        try:
+            self.db.execute(
+                'INSERT OR REPLACE INTO profiles (username, data) VALUES (?, ?)',
+                (username, json.dumps(data, ensure_ascii=False))
+            )
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving profile {username}: {e}")
+            return False
+    
+    def list_profiles(self):
+        return [row[0] for row in self.db.execute('SELECT username FROM profiles')]
+    
+    def load_friends(self, username):
+        rows = self.db.execute(
+            'SELECT friend, status FROM friends WHERE username = ?', (username,)
+        )
+        return {friend: status for friend, status in rows}
+    
+    def save_friends(self, username, friends_data):
+        try:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                self.db.execute('DELETE FROM friends WHERE username = ?', (username,))
+                self.db.executemany(
+                    'INSERT INTO friends (username, friend, status) VALUES (?, ?, ?)',
+                    [(username, friend, status) for friend, status in friends_data.items()]
+                )
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving friends of {username}: {e}")
+            return False
+    
+    def friend_status(self, username, friend):
+        row = self.db.execute(
+            'SELECT status FROM friends WHERE username = ? AND friend = ?', (username, friend)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def update_friendship(self, username, friend, change):
+        """Move the pair (username's status for friend, friend's status for
+        username) to change(pair) in one transaction, touching only those two
+        rows; None removes a side. Returns (before, after), or None if saving
+        failed."""
+        try:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                sides = ((username, friend), (friend, username))
+                before = tuple(self.friend_status(owner, other) for owner, other in sides)
+                after = change(before)
+                for (owner, other), status in zip(sides, after):
+                    if status is None:
+                        self.db.execute(
+                            'DELETE FROM friends WHERE username = ? AND friend = ?', (owner, other)
+                        )
+                    else:
+                        self.db.execute(
+                            'INSERT INTO friends (username, friend, status) VALUES (?, ?, ?) '
+                            'ON CONFLICT (username, friend) DO UPDATE SET status = excluded.status',
+                            (owner, other, status)
+                        )
+            return before, after
+        except sqlite3.Error as e:
+            print(f"Error saving friendship of {username} and {friend}: {e}")
+            return None
+    
+    def load_chats(self):
+        chats = {}
+        for chat_id, data in self.db.execute('SELECT chat_id, data FROM chats'):
+            chat_info = json.loads(data)
+            chat_info['participants'] = []
+            chats[chat_id] = chat_info
+        rows = self.db.execute(
+            'SELECT chat_id, username FROM chat_members ORDER BY chat_id, position'
+        )
+        for chat_id, username in rows:
+            if chat_id in chats:
+                chats[chat_id]['participants'].append(username)
+        # Databases from before chat_seq keep last_seq in the chat data
+        for chat_id, last_seq in self.db.execute('SELECT chat_id, last_seq FROM chat_seq'):
+            if chat_id in chats:
+                chats[chat_id]['last_seq'] = last_seq
+        return chats
+    
+    def save_chats(self, changes):
+        """Persist only the chats that changed ({chat_id: chat_info or None})"""
+        try:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                for chat_id, chat_info in changes.items():
+                    self.db.execute('DELETE FROM chat_members WHERE chat_id = ?', (chat_id,))
+                    if chat_info is None:
+                        self.db.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+                        self.db.execute('DELETE FROM chat_seq WHERE chat_id = ?', (chat_id,))
+                        self.db.execute('DELETE FROM private_chats WHERE chat_id = ?', (chat_id,))
+                        continue
+                    if chat_info.get('type') == 'private':
+                        self.index_private_chat(chat_id, chat_info)
+                    data = {k: v for k, v in chat_info.items() if k not in ('participants', 'last_seq')}
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO chats (chat_id, data) VALUES (?, ?)',
+                        (chat_id, json.dumps(data, ensure_ascii=False))
+                    )
+                    if 'last_seq' in chat_info:
+                        self.save_seq(chat_id, chat_info['last_seq'])
+                    # Older chats.json files can list a participant twice
+                    self.db.executemany(
+                        'INSERT OR IGNORE INTO chat_members (chat_id, username, position) VALUES (?, ?, ?)',
+                        [(chat_id, member, position)
+                         for position, member in enumerate(chat_info['participants'])]
+                    )
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving chats: {e}")
+            return False
+    
+    def index_private_chat(self, chat_id, chat_info):
+        """Claim a private chat's pair; the first chat stored for a pair keeps it"""
+        self.db.execute(
+            'INSERT OR IGNORE INTO private_chats (pair, chat_id) VALUES (?, ?)',
+            ('\n'.join(private_pair_key(chat_info['participants'])), chat_id)
+        )
+    
+    def load_chat(self, chat_id):
+        row = self.db.execute('SELECT data FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return None
+        chat_info = json.loads(row[0])
+        chat_info['participants'] = [member for member, in self.db.execute(
+            'SELECT username FROM chat_members WHERE chat_id = ? ORDER BY position', (chat_id,)
+        )]
+        row = self.db.execute('SELECT last_seq FROM chat_seq WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is not None:
+            chat_info['last_seq'] = row[0]
+        return chat_info
+    
+    def write_chat(self, chat_id, before, chat_info):
+        """Write a chat over its stored state, touching only the member rows
+        that changed (chat_info None deletes it)"""
+        if chat_info is None:
+            for table in ('chats', 'chat_members', 'chat_seq', 'private_chats'):
+                self.db.execute(f'DELETE FROM {table} WHERE chat_id = ?', (chat_id,))
+            return
+        data = {k: v for k, v in chat_info.items() if k not in ('participants', 'last_seq')}
+        self.db.execute(
+            'INSERT OR REPLACE INTO chats (chat_id, data) VALUES (?, ?)',
+            (chat_id, json.dumps(data, ensure_ascii=False))
+        )
+        old = before['participants'] if before is not None else []
+        removed = set(old) - set(chat_info['participants'])
+        self.db.executemany(
+            'DELETE FROM chat_members WHERE chat_id = ? AND username = ?',
+            [(chat_id, member) for member in removed]
+        )
+        added = [member for member in chat_info['participants'] if member not in old]
+        if added:
+            start = self.db.execute(
+                'SELECT COALESCE(MAX(position), -1) + 1 FROM chat_members WHERE chat_id = ?', (chat_id,)
+            ).fetchone()[0]
+            self.db.executemany(
+                'INSERT OR IGNORE INTO chat_members (chat_id, username, position) VALUES (?, ?, ?)',
+                [(chat_id, member, position) for position, member in enumerate(added, start)]
+            )
+    
+    def create_chat(self, chat_id, chat_info):
+        """Store a new chat, unless it is a private chat and its pair already
+        has one. Returns the id and stored state of the chat that holds it,
+        or None if saving failed."""
+        try:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                if chat_info['type'] == 'private':
+                    row = self.db.execute(
+                        'SELECT chat_id FROM private_chats WHERE pair = ?',
+                        ('\n'.join(private_pair_key(chat_info['participants'])),)
+                    ).fetchone()
+                    if row is not None:
+                        return row[0], self.load_chat(row[0])
+                    self.index_private_chat(chat_id, chat_info)
+                chat_info = dict(chat_info, version=1)
+                self.write_chat(chat_id, None, chat_info)
+            return chat_id, chat_info
+        except sqlite3.Error as e:
+            print(f"Error saving chat {chat_id}: {e}")
+            return None
+    
+    def change_chat(self, chat_id, change):
+        """Read-modify-write one chat in a single transaction, so workers
+        changing the same chat at once never drop each other's change.
+        change gets a copy of the stored chat (None if there is none) and
+        returns it changed, or None to delete it; every write bumps the
+        chat's version. Returns (before, after), or None if saving failed."""
+        try:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                before = self.load_chat(chat_id)
+                after = change(dict(before, participants=list(before['participants']))
+                               if before is not None else None)
+                if after != before:
+                    if after is not None:
+                        after['version'] = (before or {}).get('version', 0) + 1
+                    self.write_chat(chat_id, before, after)
+            return before, after
+        except sqlite3.Error as e:
+            print(f"Error saving chat {chat_id}: {e}")
+            return None
+    
+    def save_seq(self, chat_id, last_seq):
+        self.db.execute(
+            'INSERT INTO chat_seq (chat_id, last_seq) VALUES (?, ?) '
+            'ON CONFLICT (chat_id) DO UPDATE SET last_seq = excluded.last_seq',
+            (chat_id, last_seq)
+        )
+    
+    def save_seqs(self, seqs):
+        """Update message counters ({chat_id: last_seq}) without touching the
+        chats or their members"""
+        try:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                for chat_id, last_seq in seqs.items():
+                    self.save_seq(chat_id, last_seq)
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving message counters: {e}")
+            return False
+    
+    def load_refresh_tokens(self):
+        rows = self.db.execute(
+            'SELECT token_hash, username, expires FROM refresh_tokens WHERE expires > ?', (time.time(),)
+        )
+        return {
+            token_hash: {'username': username, 'expires': expires}
+            for token_hash, username, expires in rows
+        }
+    
+    def get_refresh_token(self, token_hash):
+        row = self.db.execute(
+            'SELECT username, expires FROM refresh_tokens WHERE token_hash = ?', (token_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'username': row[0], 'expires': row[1]}
+    
+    def save_refresh_token(self, token_hash, token):
+        try:
+            if token is None:
+                self.db.execute('DELETE FROM refresh_tokens WHERE token_hash = ?', (token_hash,))
+            else:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO refresh_tokens (token_hash, username, expires) VALUES (?, ?, ?)',
+                    (token_hash, token['username'], token['expires'])
+                )
+            return True
+        except sqlite3.Error as e:
+            print(f"Error saving refresh token: {e}")
+            return False
+
+def create_storage(backend):
+    if backend == 'sqlite':
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage()
+
+if CLUSTER_WORKERS > 1 and STORAGE_BACKEND != 'sqlite':
+    raise SystemExit("CLUSTER_WORKERS > 1 needs STORAGE_BACKEND = 'sqlite'")
+
+storage = create_storage(STORAGE_BACKEND)
+storage.initialize()
+atexit.register(storage.close)
+
+def migrate_json_to_sqlite():
+    """Import the JSON data tree into the SQLite database; returns False if
+    anything failed to copy"""
+    source = storage if isinstance(storage, JsonStorage) else JsonStorage()
+    if source is not storage:
+        source.initialize()
+    target = SqliteStorage(SQLITE_FILE)
+    target.initialize()
+    
+    failures = 0  # Each failed write has printed its error already
+    users = source.load_users()
+    for username, record in users.items():
+        if target.get_user(username) is None and not target.add_user(username, record):
+            failures += 1
+    
+    profiles = source.list_profiles()
+    for username in profiles:
+        if not target.save_profile(username, source.load_profile(username)):
+            failures += 1
+        if not target.save_friends(username, source.load_friends(username)):
+            failures += 1
+    
+    chats = source.load_chats()
+    if not target.save_chats(chats):
+        failures += 1
+    
+    for token_hash, token in source.load_refresh_tokens().items():
+        if not target.save_refresh_token(token_hash, token):
+            failures += 1
+    
+    if failures:
+        print(f"Migration to {SQLITE_FILE} incomplete: {failures} writes failed, see the errors above")
+        return False
+    print(f"Migrated {len(users)} users, {len(profiles)} user folders and {len(chats)} chats to {SQLITE_FILE}")
+    return True
+
 def load_user_data(username):
     """Load user's profile data"""
-    user_file = get_user_file(username, 'profile.json')
-    return load_json(user_file, {})
+    return run_io(storage.load_profile, username)
 
 def save_user_data(username, data):
     """Save user's profile data"""
-    user_file = get_user_file(username, 'profile.json')
-    return save_json(user_file, data)
+    return run_io(storage.save_profile, username, data)
 
 def load_user_friends(username):
     """Load user's friends list"""
-    friends_file = get_user_file(username, 'friends.json')
-    return load_json(friends_file, {})
+    return run_io(storage.load_friends, username)
 
 def save_user_friends(username, friends_data):
     """Save user's friends list"""
-    friends_file = get_user_file(username, 'friends.json')
-    return save_json(friends_file, friends_data)
+    return run_io(storage.save_friends, username, friends_data)
+
+def update_friendship(username, friend_username, change):
+    """Move (username's status for the friend, the friend's status for
+    username) to change(pair) in one storage transaction, so requests racing
+    on other workers see each other. Returns the pair as it was before, or
+    None if saving failed."""
+    result = run_io(storage.update_friendship, username, friend_username, change)
+    return result[0] if result is not None else None
+
+class UserIndex:
+    """In-memory credential index, loaded once and appended to on register"""
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self.users = {}  # {username: {'password': hash, 'created_at': iso}}
+    
+    def load(self):
+        self.users = self.storage.load_users()
+    
+    def __contains__(self, username):
+        return self.get(username) is not None
+    
+    def __len__(self):
+        return len(self.users)
+    
+    def get(self, username):
+        user = self.users.get(username)
+        if user is None and cluster.enabled:
+            # May have registered on another worker since we loaded
+            user = run_io(self.storage.get_user, username)
+            if user is not None:
+                self.users[username] = user
+        return user
+    
+    def add(self, username, record):
+        """Register a user; returns False if the username is already taken.
+        Raises OSError, and forgets the user again, if storage fails."""
+        if username in self.users:
+            return False
+        # Claimed before the write so a concurrent register sees it as taken
+        self.users[username] = record
+        if not run_io(self.storage.add_user, username, record):
+            del self.users[username]
+            raise OSError(f"Could not save user {username}")
+        return True
+
+user_index = UserIndex(storage)
+user_index.load()
+
+class RefreshTokens:
+    """Long-lived, revocable refresh tokens; only their SHA-256 digests are stored"""
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self.tokens = {}  # {token_hash: {'username', 'expires'}}
+    
+    def load(self):
+        self.tokens = self.storage.load_refresh_tokens()
+    
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+    
+    def issue(self, username):
+        token = secrets.token_urlsafe(32)
+        token_hash = self.digest(token)
+        self.tokens[token_hash] = {'username': username, 'expires': time.time() + REFRESH_TOKEN_TTL}
+        run_io(self.storage.save_refresh_token, token_hash, self.tokens[token_hash])
+        return token
+    
+    def resolve(self, token):
+        """Username the refresh token belongs to, or None if unknown or expired"""
+        token_hash = self.digest(token)
+        record = self.tokens.get(token_hash)
+        if record is None and cluster.enabled:
+            # May have been issued by another worker since we loaded
+            record = run_io(self.storage.get_refresh_token, token_hash)
+            if record is not None:
+                self.tokens[token_hash] = record
+        if record is None:
+            return None
+        if record['expires'] <= time.time():
+            self.revoke(token)
+            return None
+        return record['username']
+    
+    def rotate(self, token):
+        """Trade a refresh token for a new one: (username, new token), or None
+        if it is unknown or expired. The old token stops working, so each
+        client holds one live token at a time."""
+        username = self.resolve(token)
+        if username is None:
+            return None
+        self.revoke(token)
+        return username, self.issue(username)
+    
+    def revoke(self, token):
+        token_hash = self.digest(token)
+        known = self.tokens.pop(token_hash, None) is not None
+        if known or cluster.enabled:
+            run_io(self.storage.save_refresh_token, token_hash, None)
+        cluster.publish('refresh_revoked', token_hash=token_hash)
+    
+    def forget(self, token_hash):
+        """Drop a token another worker revoked"""
+        self.tokens.pop(token_hash, None)
+
+refresh_tokens = RefreshTokens(storage)
+refresh_tokens.load()
+
+class LockManager:
+    """Striped locks so only operations on the same chat wait"""
+    
+    def __init__(self, stripes):
+        self.stripes = [Semaphore(1) for _ in range(stripes)]
+    
+    @contextmanager
+    def hold(self, *keys):
+        """Lock every stripe the keys map to, always in index order so two
+        operations on overlapping keys can never deadlock"""
+        indexes = sorted({hash(key) % len(self.stripes) for key in keys})
+        for index in indexes:
+            self.stripes[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self.stripes[index].release()
+
+locks = LockManager(LOCK_STRIPES)
+
+def chat_lock(chat_id):
+    return ('chat', chat_id)
+
+def private_pair_key(participants):
+    """Canonical key for a private chat: the two usernames in sorted order"""
+    return tuple(sorted(participants))
+
+class ChatRegistry:
+    """In-memory view of all chats, loaded once and persisted write-behind.
+    
+    With several workers the database is the shared copy: every change is
+    written through in one storage transaction by whichever worker handles
+    it, and the other workers reload the chat when told it changed.
+    """
+    
+    def __init__(self, storage, shared=False):
+        self.storage = storage
+        self.shared = shared
+        self.chats = {}  # {chat_id: chat_info}
+        self.members = {}  # {chat_id: set(participants)}
+        self.user_chats = {}  # {username: set(chat_ids)}
+        self.private_pairs = {}  # {(userA, userB) sorted: chat_id}
+        self.recent = {}  # {chat_id: deque of recent messages}, never persisted
+        self.changed = set()  # chat_ids modified since the last flush
+        self.seq_changed = set()  # chat_ids that only numbered messages since then
+    
+    def load(self):
+        """Load all chats from storage and build the membership indexes"""
+        self.chats = self.storage.load_chats()
+        self.members = {
+            chat_id: set(chat_info.get('participants', []))
+            for chat_id, chat_info in self.chats.items()
+        }
+        self.user_chats = {}
+        for chat_id, members in self.members.items():
+            for username in members:
+                self.user_chats.setdefault(username, set()).add(chat_id)
+        self.private_pairs = {}
+        for chat_id, chat_info in self.chats.items():
+            if chat_info.get('type') == 'private':
+                self.private_pairs.setdefault(private_pair_key(chat_info['participants']), chat_id)
+            if 'last_seq' in chat_info:
+                chat_info['last_seq'] += SEQ_RESTART_GAP
+        self.changed = set()
+        self.seq_changed = set()
+    
+    def __contains__(self, chat_id):
+        return chat_id in self.chats
+    
+    def get(self, chat_id):
+        return self.chats.get(chat_id)
+    
+    def items(self):
+        return self.chats.items()
+    
+    def is_member(self, chat_id, username):
+        return username in self.members.get(chat_id, ())
+    
+    def chats_for(self, username):
+        """Chat ids the user participates in"""
+        return self.user_chats.get(username, ())
+    
+    def find_private_chat(self, participants):
+        """Chat id of the existing private chat between two users, if any"""
+        return self.private_pairs.get(private_pair_key(participants))
+    
+    def _index_member(self, chat_id, username):
+        self.user_chats.setdefault(username, set()).add(chat_id)
+    
+    def _unindex_member(self, chat_id, username):
+        chat_ids = self.user_chats.get(username)
+        if chat_ids is not None:
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self.user_chats[username]
+    
+    def _insert(self, chat_id, chat_info):
+        self.chats[chat_id] = chat_info
+        self.members[chat_id] = set(chat_info['participants'])
+        for username in self.members[chat_id]:
+            self._index_member(chat_id, username)
+        if chat_info['type'] == 'private':
+            self.private_pairs[private_pair_key(chat_info['participants'])] = chat_id
+    
+    def _drop(self, chat_id):
+        chat_info = self.chats.pop(chat_id, None)
+        for username in self.members.pop(chat_id, ()):
+            self._unindex_member(chat_id, username)
+        if chat_info is not None and chat_info['type'] == 'private':
+            key = private_pair_key(chat_info['participants'])
+            if self.private_pairs.get(key) == chat_id:
+                del self.private_pairs[key]
+        return chat_info
+    
+    def add(self, chat_id, chat_info):
+        """Register a new chat. Returns the id of the chat that holds it: a
+        private chat whose pair another worker just created returns that one."""
+        if not self.shared:
+            self._insert(chat_id, chat_info)
+            self.mark_dirty(chat_id)
+            return chat_id
+        result = run_io(self.storage.create_chat, chat_id, chat_info)
+        if result is None:
+            raise OSError(f"Could not save chat {chat_id}")
+        holder_id, stored = result
+        self.apply_remote(holder_id, stored)
+        if holder_id == chat_id:
+            cluster.publish('chat', chat_id=chat_id, version=stored['version'])
+        return holder_id
+    
+    def remove(self, chat_id):
+        if self.shared:
+            chat_info = self.chats.get(chat_id)
+            self._change(chat_id, lambda chat_info: None)
+            return chat_info
+        chat_info = self._drop(chat_id)
+        self.recent.pop(chat_id, None)
+        self.mark_dirty(chat_id)
+        return chat_info
+    
+    def apply_remote(self, chat_id, chat_info):
+        """Take over a chat's stored state after a worker changed it (None if
+        it was deleted). Versions older than the one held are ignored, and
+        the owner keeps its own sequence counter."""
+        current = self.chats.get(chat_id)
+        if (chat_info is not None and current is not None and
+                chat_info.get('version', 0) <= current.get('version', 0)):
+            return
+        self._drop(chat_id)
+        if chat_info is None:
+            self.recent.pop(chat_id, None)
+        else:
+            if current is not None and 'last_seq' in current and cluster.owns(chat_id):
+                chat_info['last_seq'] = current['last_seq']
+            self._insert(chat_id, chat_info)
+    
+    def _change(self, chat_id, change):
+        """Apply change to the stored chat in one transaction, take over the
+        result and tell the other workers; returns whether it changed
+        anything. Raises OSError if storage fails."""
+        result = run_io(self.storage.change_chat, chat_id, change)
+        if result is None:
+            raise OSError(f"Could not save chat {chat_id}")
+        before, after = result
+        if after == before:
+            return False
+        self.apply_remote(chat_id, after)
+        cluster.publish('chat', chat_id=chat_id, version=after['version'] if after else None)
+        return True
+    
+    def add_participant(self, chat_id, username):
+        """Add a member; returns False if they already were one"""
+        if self.shared:
+            def change(chat_info):
+                if chat_info is not None and username not in chat_info['participants']:
+                    chat_info['participants'].append(username)
+                return chat_info
+            return self._change(chat_id, change)
+        if self.is_member(chat_id, username):
+            return False
+        self.chats[chat_id]['participants'].append(username)
+        self.members[chat_id].add(username)
+        self._index_member(chat_id, username)
+        self.mark_dirty(chat_id)
+        return True
+    
+    def remove_participant(self, chat_id, username):
+        """Remove a member; returns False if they were not one"""
+        if self.shared:
+            def change(chat_info):
+                if chat_info is not None and username in chat_info['participants']:
+                    chat_info['participants'].remove(username)
+                return chat_info
+            return self._change(chat_id, change)
+        if not self.is_member(chat_id, username):
+            return False
+        self.chats[chat_id]['participants'].remove(username)
+        self.members[chat_id].discard(username)
+        self._unindex_member(chat_id, username)
+        self.mark_dirty(chat_id)
+        return True
+    
+    def update(self, chat_id, **fields):
+        if self.shared:
+            self._change(chat_id, lambda chat_info: chat_info and dict(chat_info, **fields))
+            return
+        self.chats[chat_id].update(fields)
+        self.mark_dirty(chat_id)
+    
+    def record_message(self, chat_id, message):
+        """Stamp a message with the chat's next sequence number and keep it
+        in the chat's recent-message ring"""
+        chat_info = self.chats[chat_id]
+        chat_info['last_seq'] = chat_info.get('last_seq', 0) + 1
+        self.seq_changed.add(chat_id)
+        message['seq'] = chat_info['last_seq']
+        recent = self.recent.get(chat_id)
+        if recent is None:
+            recent = self.recent[chat_id] = deque(maxlen=RECENT_MESSAGES_PER_CHAT)
+        recent.append(message)
+        return message
+    
+    def messages_after(self, chat_id, last_seq):
+        """Recent messages newer than last_seq, and whether the ring still
+        reaches back far enough to hold all of them"""
+        recent = self.recent.get(chat_id)
+        if not recent:
+            return [], self.chats[chat_id].get('last_seq', 0) <= last_seq
+        messages = [message for message in recent if message['seq'] > last_seq]
+        return messages, recent[0]['seq'] <= last_seq + 1
+    
+    def mark_dirty(self, chat_id):
+        """Queue a chat for the next flush"""
+        self.changed.add(chat_id)
+    
+    def flush(self):
+        """Persist chats if anything changed since the last flush. Chats that
+        only numbered messages save just their counter; with several workers
+        that is all there is to save, and only the owner numbers a chat."""
+        if not self.changed and not self.seq_changed:
+            return True
+        changed, self.changed = self.changed, set()
+        seq_changed, self.seq_changed = self.seq_changed - changed, set()
+        # The save runs on an I/O thread, so hand it copies the hub won't mutate
+        changes = {}
+        for chat_id in changed:
+            chat_info = self.chats.get(chat_id)
+            if chat_info is not None:
+                chat_info = dict(chat_info, participants=list(chat_info['participants']))
+            changes[chat_id] = chat_info
+        seqs = {
+            chat_id: self.chats[chat_id]['last_seq']
+            for chat_id in seq_changed if chat_id in self.chats
+        }
+        saved = True
+        if changes and not run_io(self.storage.save_chats, changes):
+            self.changed |= changed
+            saved = False
+        if seqs and not run_io(self.storage.save_seqs, seqs):
+            self.seq_changed |= set(seqs)
+            saved = False
+        return saved
+    
+    def run_flusher(self):
+        """Background task: periodically persist pending changes"""
+        while True:
+            socketio.sleep(CHATS_FLUSH_INTERVAL)
+            self.flush()
+
+chat_registry = ChatRegistry(storage, shared=cluster.enabled)
+chat_registry.load()
+atexit.register(chat_registry.flush)
+
+class Mailboxes:
+    """Per-user store-and-forward queues for users who are offline.
+    
+    Each mailbox is a folder of append-only segment files holding one JSON
+    entry per line. Segments are only ever appended to or deleted whole:
+    draining renames them from .seg to .sent and acknowledge() removes them
+    once the client has them, the size cap drops the oldest, and cleanup()
+    drops segments whose newest entry is past the TTL.
+    """
+    
+    def __init__(self, root, shared=False):
+        self.root = root
+        self.shared = shared  # Other worker processes use the same folders
+        self.stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+    
+    @contextmanager
+    def lock(self, username):
+        """Stripe lock, plus a file lock on the mailbox when it is shared"""
+        with self.stripes[hash(username) % len(self.stripes)]:
+            if not self.shared:
+                yield
+                return
+            lock_file = self.path(username) + '.lock'
+            os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+            with open(lock_file, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+    
+    def path(self, username):
+        digest = hashlib.md5(username.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], username)
+    
+    def segments(self, mailbox, suffixes=('.seg',)):
+        """Segment files of a mailbox, oldest first; by default only the ones
+        not yet sent"""
+        if not os.path.isdir(mailbox):
+            return []
+        return sorted(name for name in os.listdir(mailbox) if name.endswith(suffixes))
+    
+    def append_many(self, usernames, entries):
+        """Add the same entries to several mailboxes, encoding them once"""
+        lines = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries)
+        for username in usernames:
+            self.append_lines(username, lines)
+    
+    def append_lines(self, username, lines):
+        with self.lock(username):
+            mailbox = self.path(username)
+            os.makedirs(mailbox, exist_ok=True)
+            segments = self.segments(mailbox)
+            if segments and os.path.getsize(os.path.join(mailbox, segments[-1])) < MAILBOX_SEGMENT_BYTES:
+                current = segments[-1]
+            else:
+                # Numbered after the sent segments too, so renames never collide
+                numbered = self.segments(mailbox, ('.seg', '.sent'))
+                current = f"{int(numbered[-1].split('.')[0]) + 1 if numbered else 1:08d}.seg"
+                segments.append(current)
+            with open(os.path.join(mailbox, current), 'a', encoding='utf-8') as f:
+                f.write(lines)
+            
+            # Size cap: drop whole segments, oldest first, but never the current one
+            sizes = [os.path.getsize(os.path.join(mailbox, name)) for name in segments]
+            while len(segments) > 1 and sum(sizes) > MAILBOX_MAX_BYTES:
+                os.remove(os.path.join(mailbox, segments.pop(0)))
+                sizes.pop(0)
+    
+    def drain(self, username):
+        """Return every unexpired entry, ordered by chat and seq, and the
+        segments they came from. Nothing is deleted: the segments are marked
+        sent, and later drains return them again until acknowledge()."""
+        entries = []
+        claimed = []
+        cutoff = time.time() - MAILBOX_TTL
+        with self.lock(username):
+            mailbox = self.path(username)
+            for name in self.segments(mailbox, ('.seg', '.sent')):
+                segment = os.path.join(mailbox, name)
+                with open(segment, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        if entry.get('queued_at', 0) >= cutoff:
+                            entries.append(entry)
+                if name.endswith('.seg'):
+                    # New entries must not land in a segment the client may delete
+                    name = name[:-4] + '.sent'
+                    os.rename(segment, os.path.join(mailbox, name))
+                claimed.append(name)
+        entries.sort(key=lambda entry: (entry.get('chat_id', ''), entry.get('message', {}).get('seq', 0)))
+        return entries, claimed
+    
+    def acknowledge(self, username, claimed):
+        """Delete segments returned by drain() once the client has them"""
+        with self.lock(username):
+            mailbox = self.path(username)
+            for name in claimed:
+                try:
+                    os.remove(os.path.join(mailbox, name))
+                except FileNotFoundError:
+                    pass  # Acknowledged by another session already
+    
+    def cleanup(self):
+        """Delete segments that only hold expired entries"""
+        cutoff = time.time() - MAILBOX_TTL
+        if not os.path.isdir(self.root):
+            return
+        for shard in os.listdir(self.root):
+            for username in os.listdir(os.path.join(self.root, shard)):
+                if not os.path.isdir(os.path.join(self.root, shard, username)):
+                    continue  # A mailbox's .lock file
+                with self.lock(username):
+                    mailbox = self.path(username)
+                    for name in self.segments(mailbox, ('.seg', '.sent')):
+                        segment = os.path.join(mailbox, name)
+                        if os.path.getmtime(segment) < cutoff:
+                            os.remove(segment)
+    
+    def run_cleanup(self):
+        """Background task: expire old mailbox segments"""
+        while True:
+            socketio.sleep(MAILBOX_CLEANUP_INTERVAL)
+            run_io(self.cleanup)
+
+mailboxes = Mailboxes(MAILBOX_DIR, shared=cluster.enabled)
 
 def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return run_io(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
 def check_password(password, hashed):
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return run_io(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+class TokenCache:
+    """Bounded LRU of verified access tokens: {digest: (username, exp)}"""
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.revoked = {}  # {digest: exp} for tokens revoked before they expire
+    
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+    
+    def get(self, token):
+        """Username for a cached, unexpired token, otherwise None"""
+        if not self.max_size:
+            return None
+        key = self.digest(token)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+    
+    def put(self, token, username, exp):
+        if not self.max_size:
+            return
+        key = self.digest(token)
+        self.entries[key] = (username, exp)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def is_revoked(self, token):
+        return self.digest(token) in self.revoked
+    
+    def revoke(self, token, exp):
+        """Reject a token from now on, even though its signature is still valid"""
+        key = self.digest(token)
+        self.revoke_key(key, exp)
+        cluster.publish('token_revoked', key=key.hex(), exp=exp)
+    
+    def revoke_key(self, key, exp):
+        now = time.time()
+        self.revoked = {revoked: until for revoked, until in self.revoked.items() if until > now}
+        self.entries.pop(key, None)
+        if exp > now:
+            self.revoked[key] = exp
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
 
 def create_token(username):
     payload = {
         'username': username,
-        'exp': datetime.utcnow() + timedelta(days=7)
+        'exp': datetime.utcnow() + timedelta(seconds=ACCESS_TOKEN_TTL)
     }
     return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
 
-def verify_token(token):
+def decode_token(token):
     try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload['username']
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
     except:
         return None
 
+def verify_token(token):
+    if not isinstance(token, str):
+        return None
+    username = token_cache.get(token)
+    if username is not None:
+        metrics['token_cache_hits'] += 1
+        return username
+    metrics['token_cache_misses'] += 1
+    payload = decode_token(token)
+    if payload is None or token_cache.is_revoked(token):
+        return None
+    token_cache.put(token, payload['username'], payload['exp'])
+    return payload['username']
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -138,6 +1946,18 @@ def index():
         'structure': 'Individual user folders'
     })
 
+@app.route('/api/metrics')
+def get_metrics():
+    return jsonify({
+        'success': True,
+        'online_users': len(online_users),
+        'node': cluster.node,
+        'sessions': len(user_sessions),
+        'connections': len(connections),
+        'fanout_queue_depth': sum(queue.qsize() for queue in fanout_queues),
+        'metrics': metrics
+    })
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.json
@@ -149,17 +1969,19 @@ def register():
         return jsonify({'error': 'Username and password required'}), 400
     
     # Check users index
-    users_index = load_json(USERS_INDEX_FILE, {})
-    
-    if username in users_index:
+    if username in user_index:
         return jsonify({'error': 'Username already exists'}), 409
     
     # Add to users index (only username and password hash)
-    users_index[username] = {
-        'password': hash_password(password),
-        'created_at': datetime.now().isoformat()
-    }
-    save_json(USERS_INDEX_FILE, users_index)
+    try:
+        if not user_index.add(username, {
+            'password': hash_password(password),
+            'created_at': datetime.now().isoformat()
+        }):
+            return jsonify({'error': 'Username already exists'}), 409
+    except OSError as e:
+        print(f"Error registering {username}: {e}")
+        return jsonify({'error': 'Registration failed, please try again'}), 500
     
     # Create user directory and profile
     user_profile = {
@@ -179,6 +2001,8 @@ def register():
     return jsonify({
         'success': True,
         'token': token,
+        'refresh_token': refresh_tokens.issue(username),
+        'expires_in': ACCESS_TOKEN_TTL,
         'username': username
     })
 
@@ -191,13 +2015,11 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
-    users_index = load_json(USERS_INDEX_FILE, {})
+    user = user_index.get(username)
     
-    if username not in users_index:
+    if user is None:
         return jsonify({'error': 'Invalid credentials'}), 401
     
-    user = users_index[username]
-    
     if not check_password(password, user['password']):
         return jsonify({'error': 'Invalid credentials'}), 401
     
@@ -209,10 +2031,48 @@ def login():
     return jsonify({
         'success': True,
         'token': token,
+        'refresh_token': refresh_tokens.issue(username),
+        'expires_in': ACCESS_TOKEN_TTL,
         'username': username,
         'display_name': profile.get('display_name', username)
     })
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def refresh():
+    """Trade a refresh token for a new access token and a new refresh
+    token, without a password check; the old refresh token is revoked"""
+    data = request.json or {}
+    token = data.get('refresh_token', '')
+    
+    rotated = refresh_tokens.rotate(token) if token else None
+    if rotated is None or rotated[0] not in user_index:
+        return jsonify({'error': 'Invalid refresh token'}), 401
+    username, new_refresh_token = rotated
+    
+    return jsonify({
+        'success': True,
+        'token': create_token(username),
+        'refresh_token': new_refresh_token,
+        'expires_in': ACCESS_TOKEN_TTL,
+        'username': username
+    })
+
+@app.route('/api/auth/logout', methods=['POST'])
+def logout():
+    """Revoke a refresh token, and the access token sent along with it"""
+    data = request.json or {}
+    token = data.get('refresh_token', '')
+    if token:
+        refresh_tokens.revoke(token)
+    
+    access_token = request.headers.get('Authorization', '')
+    if access_token.startswith('Bearer '):
+        access_token = access_token[7:]
+    payload = decode_token(access_token) if access_token else None
+    if payload is not None:
+        token_cache.revoke(access_token, payload['exp'])
+    return jsonify({'success': True})
+
 @app.route('/api/friends', methods=['GET'])
 @token_required
 def get_friends(username):
@@ -224,10 +2084,10 @@ def get_friends(username):
     
     for friend_username, status in user_friends.items():
         if status == 'accepted':
-            is_online = friend_username in online_users
+            online = is_online(friend_username)
             friends_list.append({
                 'username': friend_username,
-                'status': 'online' if is_online else 'offline'
+                'status': 'online' if online else 'offline'
             })
         elif status == 'pending':
             pending_outgoing.append(friend_username)
@@ -251,15 +2111,8 @@ def delete_friend(username):
         return jsonify({'error': 'Friend username required'}), 400
     
     # Remove from both users' friends lists
-    user_friends = load_user_friends(username)
-    if friend_username in user_friends:
-        del user_friends[friend_username]
-        save_user_friends(username, user_friends)
-    
-    friend_friends = load_user_friends(friend_username)
-    if username in friend_friends:
-        del friend_friends[username]
-        save_user_friends(friend_username, friend_friends)
+    if update_friendship(username, friend_username, lambda pair: (None, None)) is None:
+        return jsonify({'error': 'Could not delete friend, please try again'}), 500
     
     return jsonify({'success': True, 'message': 'Friend deleted'})
 
@@ -275,30 +2128,25 @@ def add_friend(username):
     if friend_username == username:
         return jsonify({'error': 'Cannot add yourself'}), 400
     
-    users_index = load_json(USERS_INDEX_FILE, {})
-    if friend_username not in users_index:
+    if friend_username not in user_index:
         return jsonify({'error': 'User not found'}), 404
     
-    user_friends = load_user_friends(username)
+    # Add pending request, and the incoming request to the friend
+    before = update_friendship(
+        username, friend_username,
+        lambda pair: pair if pair[0] is not None else ('pending', 'request')
+    )
+    if before is None:
+        return jsonify({'error': 'Could not send friend request, please try again'}), 500
     
-    if friend_username in user_friends:
+    if before[0] is not None:
         return jsonify({'error': 'Friend request already sent or already friends'}), 409
     
-    # Add pending request
-    user_friends[friend_username] = 'pending'
-    save_user_friends(username, user_friends)
-    
-    # Add incoming request to friend
-    friend_friends = load_user_friends(friend_username)
-    friend_friends[username] = 'request'
-    save_user_friends(friend_username, friend_friends)
-    
-    # Notify if online
-    if friend_username in online_users:
-        socketio.emit('friend_request', {
-            'from': username,
-            'timestamp': datetime.now().isoformat()
-        }, room=online_users[friend_username])
+    # Notify every session of the friend, on whichever worker it is
+    socketio.emit('friend_request', {
+        'from': username,
+        'timestamp': datetime.now().isoformat()
+    }, room=user_room(friend_username))
     
     return jsonify({'success': True, 'message': 'Friend request sent'})
 
@@ -308,24 +2156,21 @@ def accept_friend(username):
     data = request.json
     friend_username = data.get('username', '').strip()
     
-    user_friends = load_user_friends(username)
-    
-    if friend_username not in user_friends or user_friends[friend_username] != 'request':
-        return jsonify({'error': 'Friend request not found'}), 404
-    
     # Accept the request
-    user_friends[friend_username] = 'accepted'
-    save_user_friends(username, user_friends)
-    
-    friend_friends = load_user_friends(friend_username)
-    friend_friends[username] = 'accepted'
-    save_user_friends(friend_username, friend_friends)
+    before = update_friendship(
+        username, friend_username,
+        lambda pair: ('accepted', 'accepted') if pair[0] == 'request' else pair
+    )
+    if before is None:
+        return jsonify({'error': 'Could not accept friend request, please try again'}), 500
+    
+    if before[0] != 'request':
+        return jsonify({'error': 'Friend request not found'}), 404
     
-    # Notify both users
-    if friend_username in online_users:
-        socketio.emit('friend_accepted', {
-            'username': username
-        }, room=online_users[friend_username])
+    # Notify every session of the friend, on whichever worker it is
+    socketio.emit('friend_accepted', {
+        'username': username
+    }, room=user_room(friend_username))
     
     return jsonify({'success': True, 'message': 'Friend request accepted'})
 
@@ -335,53 +2180,43 @@ def reject_friend(username):
     data = request.json
     friend_username = data.get('username', '').strip()
     
-    user_friends = load_user_friends(username)
+    # Simply remove the request (reject it), and the other user's sent request
+    def reject(pair):
+        if pair[0] != 'request':
+            return pair
+        return None, None if pair[1] == 'pending' else pair[1]
+    before = update_friendship(username, friend_username, reject)
+    if before is None:
+        return jsonify({'error': 'Could not reject friend request, please try again'}), 500
     
-    if friend_username not in user_friends or user_friends[friend_username] != 'request':
+    if before[0] != 'request':
         return jsonify({'error': 'Friend request not found'}), 404
     
-    # Simply remove the request (reject it)
-    del user_friends[friend_username]
-    save_user_friends(username, user_friends)
-    
-    # Also remove from the other user's sent requests
-    friend_friends = load_user_friends(friend_username)
-    if username in friend_friends and friend_friends[username] == 'pending':
-        del friend_friends[username]
-        save_user_friends(friend_username, friend_friends)
-    
     return jsonify({'success': True, 'message': 'Friend request rejected'})
 
 @app.route('/api/chats', methods=['GET'])
 @token_required
 def get_chats(username):
-    chats_data = load_json(CHATS_FILE, {})
-    
     user_chats = []
-    needs_save = False
-    for chat_id, chat_info in chats_data.items():
-        if username in chat_info['participants']:
-            # Migration: Fix old groups without admin field
-            if chat_info['type'] == 'group' and 'admin' not in chat_info:
-                # Set creator as admin, or first participant if creator unknown
-                admin = chat_info.get('created_by', chat_info['participants'][0])
-                chat_info['admin'] = admin
-                needs_save = True
-            
-            user_chats.append({
-                'chat_id': chat_id,
-                'type': chat_info['type'],
-                'name': chat_info.get('name', ''),
-                'participants': chat_info['participants'],
-                'admin': chat_info.get('admin'),  # Include admin for groups
-                'created_by': chat_info.get('created_by'),  # Include creator
-                'last_message': None,  # Messages stored locally
-                'unread_count': 0  # Tracked locally
-            })
-    
-    # Save if we migrated any old groups
-    if needs_save:
-        save_json(CHATS_FILE, chats_data)
+    for chat_id in chat_registry.chats_for(username):
+        chat_info = chat_registry.get(chat_id)
+        # Migration: Fix old groups without admin field
+        if chat_info['type'] == 'group' and 'admin' not in chat_info:
+            # Set creator as admin, or first participant if creator unknown
+            admin = chat_info.get('created_by', chat_info['participants'][0])
+            chat_registry.update(chat_id, admin=admin)
+            chat_info = chat_registry.get(chat_id)
+        
+        user_chats.append({
+            'chat_id': chat_id,
+            'type': chat_info['type'],
+            'name': chat_info.get('name', ''),
+            'participants': chat_info['participants'],
+            'admin': chat_info.get('admin'),  # Include admin for groups
+            'created_by': chat_info.get('created_by'),  # Include creator
+            'last_message': None,  # Messages stored locally
+            'unread_count': 0  # Tracked locally
+        })
     
     return jsonify({
         'success': True,
@@ -392,7 +2227,7 @@ def get_chats(username):
 @token_required
 def create_chat(username):
     data = request.json
-    participants = data.get('participants', [])
+    participants = list(dict.fromkeys(data.get('participants', [])))  # Drop repeats, keep order
     chat_type = data.get('type', 'private')
     chat_name = data.get('name', '')
     
@@ -408,48 +2243,45 @@ def create_chat(username):
     if chat_type == 'group' and not chat_name:
         return jsonify({'error': 'Group name required'}), 400
     
-    chats_data = load_json(CHATS_FILE, {})
-    
-    # Check if private chat already exists
+    # Check if private chat already exists. On one worker there is no yield
+    # point between this lookup and chat_registry.add below; across workers
+    # the add itself returns the pair's chat if another worker created it.
     if chat_type == 'private':
-        for chat_id, chat_info in chats_data.items():
-            if chat_info['type'] == 'private' and set(chat_info['participants']) == set(participants):
-                return jsonify({
-                    'success': True,
-                    'chat_id': chat_id,
-                    'existing': True
-                })
+        existing_id = chat_registry.find_private_chat(participants)
+        if existing_id is not None:
+            return jsonify({
+                'success': True,
+                'chat_id': existing_id,
+                'existing': True
+            })
     
     # Create new chat
-    chat_id = f"chat_{int(time.time() * 1000)}"
-    chats_data[chat_id] = {
+    new_id = ids.new('chat')
+    chat_id = chat_registry.add(new_id, {
         'type': chat_type,
         'name': chat_name if chat_type == 'group' else '',
         'participants': participants,
         'created_at': datetime.now().isoformat(),
         'created_by': username,
         'admin': username if chat_type == 'group' else None
-    }
-    
-    save_json(CHATS_FILE, chats_data)
+    })
+    if chat_id != new_id:
+        return jsonify({
+            'success': True,
+            'chat_id': chat_id,
+            'existing': True
+        })
+    for participant in participants:
+        join_chat_room(participant, chat_id)
     
-    # For groups, send automatic welcome message to all members
+    # For groups, send automatic welcome message to all members (including creator)
     if chat_type == 'group':
-        # Create welcome message
-        welcome_msg = {
+        post_message(chat_id, {
             'sender': 'System',
             'message': f'{username} created the group "{chat_name}" and added you',
             'timestamp': datetime.now().isoformat(),
             'is_action': False
-        }
-        
-        # Send message to all participants (including creator)
-        for participant in participants:
-            if participant in online_users:
-                socketio.emit('new_message', {
-                    'chat_id': chat_id,
-                    'message': welcome_msg
-                }, room=online_users[participant])
+        })
     
     return jsonify({
         'success': True,
@@ -459,17 +2291,16 @@ def create_chat(username):
 @app.route('/api/chats/delete/<chat_id>', methods=['DELETE'])
 @token_required
 def delete_chat(username, chat_id):
-    chats_data = load_json(CHATS_FILE, {})
-    
-    if chat_id not in chats_data:
-        return jsonify({'error': 'Chat not found'}), 404
-    
-    if username not in chats_data[chat_id]['participants']:
-        return jsonify({'error': 'Not authorized'}), 403
-    
-    # Delete chat (messages are local, so just remove chat reference)
-    del chats_data[chat_id]
-    save_json(CHATS_FILE, chats_data)
+    with locks.hold(chat_lock(chat_id)):
+        if chat_id not in chat_registry:
+            return jsonify({'error': 'Chat not found'}), 404
+        
+        if not chat_registry.is_member(chat_id, username):
+            return jsonify({'error': 'Not authorized'}), 403
+        
+        # Delete chat (messages are local, so just remove chat reference)
+        chat_registry.remove(chat_id)
+        close_chat_room(chat_id)
     
     return jsonify({'success': True, 'message': 'Chat deleted'})
 
@@ -483,28 +2314,24 @@ def add_group_member(username):
     chat_id = data.get('chat_id')
     new_member = data.get('username')
     
-    chats_data = load_json(CHATS_FILE, {})
-    
-    if chat_id not in chats_data:
-        return jsonify({'error': 'Chat not found'}), 404
-    
-    chat = chats_data[chat_id]
-    
-    if chat.get('admin') != username:
-        return jsonify({'error': 'Not authorized'}), 403
-    
-    if new_member not in chat['participants']:
-        chat['participants'].append(new_member)
-        save_json(CHATS_FILE, chats_data)
+    with locks.hold(chat_lock(chat_id)):
+        chat = chat_registry.get(chat_id)
         
-        for participant in chat['participants']:
-            if participant in online_users:
-                socketio.emit('group_member_added', {
-                    'chat_id': chat_id,
-                    'username': new_member,
-                    'added_by': username,
-                    'group_name': chat.get('name', 'Group')
-                }, room=online_users[participant])
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        
+        if chat.get('admin') != username:
+            return jsonify({'error': 'Not authorized'}), 403
+        
+        if chat_registry.add_participant(chat_id, new_member):
+            join_chat_room(new_member, chat_id)
+            
+            socketio.emit('group_member_added', {
+                'chat_id': chat_id,
+                'username': new_member,
+                'added_by': username,
+                'group_name': chat.get('name', 'Group')
+            }, room=chat_room(chat_id))
     
     return jsonify({'success': True})
 
@@ -515,39 +2342,28 @@ def remove_group_member(username):
     chat_id = data.get('chat_id')
     remove_member = data.get('username')
     
-    chats_data = load_json(CHATS_FILE, {})
-    
-    if chat_id not in chats_data:
-        return jsonify({'error': 'Chat not found'}), 404
-    
-    chat = chats_data[chat_id]
-    
-    if chat.get('admin') != username:
-        return jsonify({'error': 'Not authorized'}), 403
-    
-    if remove_member == chat.get('admin'):
-        return jsonify({'error': 'Cannot remove admin'}), 400
-    
-    if remove_member in chat['participants']:
-        chat['participants'].remove(remove_member)
-        save_json(CHATS_FILE, chats_data)
+    with locks.hold(chat_lock(chat_id)):
+        chat = chat_registry.get(chat_id)
+        
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
         
-        for participant in chat['participants']:
-            if participant in online_users:
-                socketio.emit('group_member_removed', {
-                    'chat_id': chat_id,
-                    'username': remove_member,
-                    'removed_by': username,
-                    'group_name': chat.get('name', 'Group')
-                }, room=online_users[participant])
+        if chat.get('admin') != username:
+            return jsonify({'error': 'Not authorized'}), 403
         
-        if remove_member in online_users:
+        if remove_member == chat.get('admin'):
+            return jsonify({'error': 'Cannot remove admin'}), 400
+        
+        if chat_registry.remove_participant(chat_id, remove_member):
+            
+            # The removed member is still in the room, so this reaches them too
             socketio.emit('group_member_removed', {
                 'chat_id': chat_id,
                 'username': remove_member,
                 'removed_by': username,
                 'group_name': chat.get('name', 'Group')
-            }, room=online_users[remove_member])
+            }, room=chat_room(chat_id))
+            leave_chat_room(remove_member, chat_id)
     
     return jsonify({'success': True})
 
@@ -561,28 +2377,24 @@ def rename_group(username):
     if not new_name:
         return jsonify({'error': 'Name required'}), 400
     
-    chats_data = load_json(CHATS_FILE, {})
-    
-    if chat_id not in chats_data:
-        return jsonify({'error': 'Chat not found'}), 404
-    
-    chat = chats_data[chat_id]
-    
-    if chat.get('admin') != username:
-        return jsonify({'error': 'Not authorized'}), 403
-    
-    old_name = chat.get('name', '')
-    chat['name'] = new_name
-    save_json(CHATS_FILE, chats_data)
-    
-    for participant in chat['participants']:
-        if participant in online_users:
-            socketio.emit('group_renamed', {
-                'chat_id': chat_id,
-                'old_name': old_name,
-                'new_name': new_name,
-                'renamed_by': username
-            }, room=online_users[participant])
+    with locks.hold(chat_lock(chat_id)):
+        chat = chat_registry.get(chat_id)
+        
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        
+        if chat.get('admin') != username:
+            return jsonify({'error': 'Not authorized'}), 403
+        
+        old_name = chat.get('name', '')
+        chat_registry.update(chat_id, name=new_name)
+        
+        socketio.emit('group_renamed', {
+            'chat_id': chat_id,
+            'old_name': old_name,
+            'new_name': new_name,
+            'renamed_by': username
+        }, room=chat_room(chat_id))
     
     return jsonify({'success': True})
 
@@ -595,86 +2407,517 @@ def transfer_admin(username):
     chat_id = data.get('chat_id')
     new_admin = data.get('new_admin')
     
-    chats_data = load_json(CHATS_FILE, {})
-    
-    if chat_id not in chats_data:
-        return jsonify({'error': 'Chat not found'}), 404
-    
-    chat = chats_data[chat_id]
-    
-    # Only current admin can transfer
-    if chat.get('admin') != username:
-        return jsonify({'error': 'Not authorized'}), 403
-    
-    # New admin must be in group
-    if new_admin not in chat['participants']:
-        return jsonify({'error': 'User not in group'}), 400
-    
-    # Transfer admin
-    old_admin = chat.get('admin')
-    chat['admin'] = new_admin
-    save_json(CHATS_FILE, chats_data)
-    
-    # Send notification message to group
-    transfer_msg = {
-        'sender': 'System',
-        'message': f'{old_admin} transferred admin rights to {new_admin}',
-        'timestamp': datetime.now().isoformat(),
-        'is_action': False
-    }
-    
-    # Notify all participants
-    for participant in chat['participants']:
-        if participant in online_users:
-            socketio.emit('new_message', {
-                'chat_id': chat_id,
-                'message': transfer_msg
-            }, room=online_users[participant])
-            # Also send event for immediate admin status update
-            socketio.emit('admin_transferred', {
-                'chat_id': chat_id,
-                'old_admin': old_admin,
-                'new_admin': new_admin
-            }, room=online_users[participant])
+    with locks.hold(chat_lock(chat_id)):
+        chat = chat_registry.get(chat_id)
+        
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        
+        # Only current admin can transfer
+        if chat.get('admin') != username:
+            return jsonify({'error': 'Not authorized'}), 403
+        
+        # New admin must be in group
+        if not chat_registry.is_member(chat_id, new_admin):
+            return jsonify({'error': 'User not in group'}), 400
+        
+        # Transfer admin
+        old_admin = chat.get('admin')
+        chat_registry.update(chat_id, admin=new_admin)
+        
+        # Send notification message to group
+        post_message(chat_id, {
+            'sender': 'System',
+            'message': f'{old_admin} transferred admin rights to {new_admin}',
+            'timestamp': datetime.now().isoformat(),
+            'is_action': False
+        })
+        # Also send event for immediate admin status update
+        socketio.emit('admin_transferred', {
+            'chat_id': chat_id,
+            'old_admin': old_admin,
+            'new_admin': new_admin
+        }, room=chat_room(chat_id))
     
     return jsonify({'success': True})
 
 @app.route('/api/chats/group/delete/<chat_id>', methods=['DELETE'])
 @token_required
 def delete_group(username, chat_id):
-    chats_data = load_json(CHATS_FILE, {})
-    
-    if chat_id not in chats_data:
-        return jsonify({'error': 'Chat not found'}), 404
-    
-    chat = chats_data[chat_id]
-    
-    if chat.get('admin') != username:
-        return jsonify({'error': 'Not authorized'}), 403
-    
-    group_name = chat.get('name', 'Group')
-    participants = chat['participants']
-    
-    del chats_data[chat_id]
-    save_json(CHATS_FILE, chats_data)
-    
-    for participant in participants:
-        if participant in online_users:
-            socketio.emit('group_deleted', {
-                'chat_id': chat_id,
-                'group_name': group_name,
-                'deleted_by': username
-            }, room=online_users[participant])
+    with locks.hold(chat_lock(chat_id)):
+        chat = chat_registry.get(chat_id)
+        
+        if chat is None:
+            return jsonify({'error': 'Chat not found'}), 404
+        
+        if chat.get('admin') != username:
+            return jsonify({'error': 'Not authorized'}), 403
+        
+        group_name = chat.get('name', 'Group')
+        
+        chat_registry.remove(chat_id)
+        
+        socketio.emit('group_deleted', {
+            'chat_id': chat_id,
+            'group_name': group_name,
+            'deleted_by': username
+        }, room=chat_room(chat_id))
+        close_chat_room(chat_id)
     
     return jsonify({'success': True})
 
 
+# Sessions and Rooms
+
+def chat_sessions(chat_id):
+    """Sids of every online session of every participant of a chat"""
+    chat = chat_registry.get(chat_id)
+    if chat is None:
+        return []
+    return [sid for participant in chat['participants']
+            for sid in online_users.get(participant, ())]
+
+def deliver_message(chat_id, payload):
+    """Send a new_message to a chat; the packet is encoded once and the same
+    frame is written to all of its sessions"""
+    sids = chat_sessions(chat_id)
+    encodes_before = CountingPacket.encode_count
+    # Other workers' sessions can only be reached through the room
+    if cluster.enabled or len(sids) <= FANOUT_CHUNK_SIZE:
+        socketio.emit('new_message', payload, room=chat_room(chat_id))
+        record_message_encodes(CountingPacket.encode_count - encodes_before)
+        return
+    
+    # Large group: write the frame a chunk of sessions at a time, yielding
+    # in between so other greenlets keep running
+    packets = encode_event('new_message', payload)
+    encodes = CountingPacket.encode_count - encodes_before
+    for start in range(0, len(sids), FANOUT_CHUNK_SIZE):
+        for sid in sids[start:start + FANOUT_CHUNK_SIZE]:
+            eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+            if eio_sid is not None:
+                for eio_packet in packets:
+                    socketio.server._send_eio_packet(eio_sid, eio_packet)
+        socketio.sleep(0)
+    record_message_encodes(encodes)
+
+def encode_event(event, data):
+    """Engine.IO packets of a Socket.IO event, as a room emit builds them, so
+    they can be written to any number of sessions"""
+    encoded = socketio.server.packet_class(EVENT, namespace='/', data=[event, data]).encode()
+    if not isinstance(encoded, list):
+        encoded = [encoded]
+    return [EnginePacket(MESSAGE, part) for part in encoded]
+
+def store_for_offline(chat_id, participants, payload):
+    """Keep a chat message for participants with no connected session"""
+    offline = [participant for participant in participants if not is_connected(participant)]
+    if not offline:
+        return
+    # One trip to the I/O thread for the whole chat, not one per participant
+    run_io(mailboxes.append_many, offline, [dict(payload, queued_at=time.time())])
+    for participant in offline:
+        # They may have connected (and drained) while we were writing
+        if is_connected(participant):
+            hand_over_mailbox(participant)
+
+def hand_over_mailbox(username):
+    """Deliver a user's mailbox to one of their sessions, on whichever
+    worker has one"""
+    sids = online_users.get(username)
+    if sids:
+        deliver_mailbox(username, next(iter(sids)))
+    else:
+        cluster.publish('mailbox', username=username)
+
+def deliver_mailbox(username, sid):
+    """Send everything queued for a user to one session as a missed_messages
+    event. The mailbox is emptied when the client acknowledges the event; if
+    the socket drops first, the next session gets the same entries again."""
+    entries, claimed = run_io(mailboxes.drain, username)
+    if not entries:
+        if claimed:
+            run_io(mailboxes.acknowledge, username, claimed)  # Only expired entries
+        return
+    for entry in entries:
+        entry.pop('queued_at', None)
+    socketio.server.emit(
+        'missed_messages', {'messages': entries}, to=sid, namespace='/',
+        callback=lambda *args: run_io(mailboxes.acknowledge, username, claimed)
+    )
+
+def queue_message(chat_id, message, queued_at):
+    """Number a chat message and hand it to the fanout workers"""
+    chat_registry.record_message(chat_id, message)
+    fanout_queue_for(chat_id).put((chat_id, {'chat_id': chat_id, 'message': message}, queued_at))
+
+def fanout_queue_for(chat_id):
+    """The queue of the fanout worker that delivers a chat's messages"""
+    return fanout_queues[zlib.crc32(chat_id.encode('utf-8')) % len(fanout_queues)]
+
+def post_message(chat_id, message):
+    """Send a message to a chat through the worker that owns it; returns the
+    message, numbered unless another worker does that"""
+    if cluster.owns(chat_id):
+        queue_message(chat_id, message, time.time())
+    else:
+        cluster.publish('post', chat_id=chat_id, message=message, queued_at=time.time())
+    return message
+
+def run_fanout_worker(queue):
+    """Background task: deliver the chat messages on one fanout queue, in order"""
+    while True:
+        chat_id, payload, queued_at = queue.get()
+        lag = time.time() - queued_at
+        metrics['fanout_lag_last'] = lag
+        metrics['fanout_lag_max'] = max(metrics['fanout_lag_max'], lag)
+        try:
+            deliver_message(chat_id, payload)
+            chat = chat_registry.get(chat_id)
+            if chat is not None:
+                store_for_offline(chat_id, list(chat['participants']), payload)
+        except Exception as e:
+            print(f"Error in fanout: {e}")
+
+def record_message_encodes(encodes):
+    metrics['messages_sent'] += 1
+    metrics['message_encodes'] += encodes
+    metrics['last_encodes_per_message'] = encodes
+    metrics['max_encodes_per_message'] = max(metrics['max_encodes_per_message'], encodes)
+
+def outbound_depth(sid):
+    """Packets waiting in a session's Engine.IO send queue"""
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        eio_socket = socketio.server.eio.sockets.get(eio_sid)
+        return eio_socket.queue.qsize() if eio_socket else 0
+    except Exception:
+        return 0
+
+def is_connected(username):
+    """Has a session on this or another worker"""
+    return username in online_users or cluster.remote_online(username)
+
+def is_online(username):
+    """Online, or disconnected too recently to have been announced offline"""
+    return is_connected(username) or username in offline_pending
+
+def presence_snapshot(username, user_friends):
+    """Online state of every accepted friend, versioned so the client can
+    tell whether it missed any presence_batch after it"""
+    return {
+        'version': presence_versions.get(username, 0),
+        'friends': {
+            friend_username: 'online' if is_online(friend_username) else 'offline'
+            for friend_username, status in user_friends.items()
+            if status == 'accepted'
+        }
+    }
+
+def accepted_friends(user_friends):
+    return [friend_username for friend_username, status in user_friends.items()
+            if status == 'accepted']
+
+def queue_presence(username, status, friends):
+    """Queue a presence change for the friends with a session on this worker"""
+    for friend_username in friends:
+        if friend_username in online_users:
+            presence_updates.setdefault(friend_username, {})[username] = status
+
+def announce_presence(username, status, user_friends=None):
+    """Queue a presence change for the user's online friends"""
+    if user_friends is None:
+        user_friends = load_user_friends(username)
+    friends = accepted_friends(user_friends)
+    queue_presence(username, status, friends)
+    cluster.publish('presence', username=username, status=status, friends=friends)
+
+def announce_offline_after_grace(username, disconnected_at):
+    """Background task: announce offline unless the user came back"""
+    socketio.sleep(PRESENCE_OFFLINE_GRACE)
+    if offline_pending.get(username) != disconnected_at:
+        return  # Reconnected (or disconnected again later)
+    del offline_pending[username]
+    announce_presence(username, 'offline')
+
+def send_presence(recipient, changes):
+    """Send a presence_batch to every session of a user on this worker;
+    sessions that are backed up only keep the latest state per friend until
+    they drain. Batches are numbered per recipient and worker; 'since' is the
+    first version a (possibly coalesced) batch covers."""
+    version = presence_versions.get(recipient, 0) + 1
+    presence_versions[recipient] = version
+    sids = []
+    for sid in online_users.get(recipient, ()):
+        if outbound_depth(sid) >= OUTBOUND_PRESENCE_LIMIT:
+            pending = pending_presence.setdefault(sid, {'since': version, 'changes': {}})
+            pending['version'] = version
+            pending['changes'].update(changes)
+            metrics['presence_coalesced'] += len(changes)
+        else:
+            sids.append(sid)
+    if sids:
+        socketio.emit('presence_batch', {
+            'since': version,
+            'version': version,
+            'changes': changes
+        }, to=sids)
+
+def run_presence_batcher():
+    """Background task: send the presence changes collected per recipient"""
+    while True:
+        socketio.sleep(PRESENCE_BATCH_INTERVAL)
+        updates = dict(presence_updates)
+        presence_updates.clear()
+        for recipient, changes in updates.items():
+            send_presence(recipient, changes)
+
+def run_outbound_monitor():
+    """Background task: flush coalesced presence, track queue depths and
+    disconnect sessions that stay saturated"""
+    while True:
+        socketio.sleep(OUTBOUND_CHECK_INTERVAL)
+        now = time.time()
+        total = deepest = saturated = 0
+        for sid in list(user_sessions):
+            depth = outbound_depth(sid)
+            total += depth
+            deepest = max(deepest, depth)
+            
+            if depth >= OUTBOUND_TYPING_LIMIT:
+                typing_backlogged.add(sid)
+            else:
+                typing_backlogged.discard(sid)
+            
+            if depth < OUTBOUND_PRESENCE_LIMIT and sid in pending_presence:
+                socketio.emit('presence_batch', pending_presence.pop(sid), to=sid)
+            
+            if depth < OUTBOUND_SESSION_LIMIT:
+                saturated_since.pop(sid, None)
+                continue
+            saturated += 1
+            since = saturated_since.setdefault(sid, now)
+            if now - since >= SLOW_CONSUMER_GRACE:
+                print(f"Disconnecting slow consumer: {user_sessions.get(sid)} ({depth} queued)")
+                metrics['slow_consumers_disconnected'] += 1
+                saturated_since.pop(sid, None)
+                socketio.server.disconnect(sid, namespace='/')
+        
+        metrics['outbound_queue_depth_total'] = total
+        metrics['outbound_queue_depth_max'] = deepest
+        metrics['saturated_sessions'] = saturated
+
+def connection_allowed(ip):
+    """Whether another socket fits in the global and per-address budget"""
+    return (len(connections) < MAX_CONNECTIONS and
+            connections_per_ip.get(ip, 0) < MAX_CONNECTIONS_PER_IP)
+
+def track_connection(eio_sid, ip):
+    connections[eio_sid] = (ip, time.time())
+    connections_per_ip[ip] = connections_per_ip.get(ip, 0) + 1
+
+def untrack_connection(eio_sid):
+    ip, _ = connections.pop(eio_sid, (None, None))
+    if ip is None:
+        return
+    if connections_per_ip.get(ip, 0) <= 1:
+        connections_per_ip.pop(ip, None)
+    else:
+        connections_per_ip[ip] -= 1
+
+def handle_eio_connect(eio_sid, environ):
+    """Engine.IO connect, before any Socket.IO packet: admit the socket into
+    the budget or refuse the handshake with HTTP 401 "busy", which clients
+    back off from"""
+    ip = environ.get('REMOTE_ADDR')
+    if not connection_allowed(ip):
+        metrics['connections_over_budget'] += 1
+        return 'busy'
+    track_connection(eio_sid, ip)
+    return socketio.server._handle_eio_connect(eio_sid, environ)
+
+def handle_eio_disconnect(eio_sid, reason):
+    untrack_connection(eio_sid)
+    return socketio.server._handle_eio_disconnect(eio_sid, reason)
+
+socketio.server.eio.on('connect', handle_eio_connect)
+socketio.server.eio.on('disconnect', handle_eio_disconnect)
+
+def run_auth_reaper():
+    """Background task: close sockets that never authenticated, including
+    ones that never sent a Socket.IO CONNECT at all"""
+    while True:
+        socketio.sleep(AUTH_DEADLINE / 2)
+        deadline = time.time() - AUTH_DEADLINE
+        for eio_sid, (ip, connected_at) in list(connections.items()):
+            if connected_at > deadline:
+                continue
+            if socketio.server.manager.sid_from_eio_sid(eio_sid, '/') in user_sessions:
+                continue
+            print(f"Closing unauthenticated socket from {ip}")
+            metrics['connections_reaped'] += 1
+            untrack_connection(eio_sid)
+            # Don't wait for the close packet to go out: a socket that never
+            # connected may never poll for it
+            eio_socket = socketio.server.eio.sockets.pop(eio_sid, None)
+            if eio_socket is not None:
+                eio_socket.close(wait=False, abort=True)
+
+def user_room(username):
+    """Socket.IO room joined by every session of a user"""
+    return f"user:{username}"
+
+def chat_room(chat_id):
+    """Socket.IO room joined by every session of every chat participant"""
+    return f"chat:{chat_id}"
+
+def join_chat_room(username, chat_id):
+    for sid in online_users.get(username, ()):
+        join_room(chat_room(chat_id), sid=sid, namespace='/')
+
+def leave_chat_room(username, chat_id):
+    for sid in online_users.get(username, ()):
+        leave_room(chat_room(chat_id), sid=sid, namespace='/')
+    cluster.publish('leave', username=username, chat_id=chat_id)
+
+def close_chat_room(chat_id):
+    socketio.close_room(chat_room(chat_id), namespace='/')
+
+def add_session(sid, username):
+    """Register a session; returns True if it is the user's first one"""
+    remove_session(sid)
+    user_sessions[sid] = username
+    sids = online_users.setdefault(username, set())
+    sids.add(sid)
+    return len(sids) == 1
+
+def remove_session(sid):
+    """Forget a session; returns (username, True if it was the last one)"""
+    username = user_sessions.pop(sid, None)
+    if username is None:
+        return None, False
+    sids = online_users.get(username, set())
+    sids.discard(sid)
+    if sids:
+        return username, False
+    online_users.pop(username, None)
+    return username, True
+
+def resync_result(chat_id, last_seq):
+    messages, complete = chat_registry.messages_after(chat_id, last_seq)
+    return {'messages': messages, 'complete': complete}
+
+def handle_cluster_event(event, data):
+    """Apply an event published by another worker (see Cluster.publish)"""
+    if event == 'sessions':
+        cluster.heartbeat(data['node'], data['users'])
+    elif event == 'session_up':
+        cluster.session_up(data['node'], data['username'])
+        offline_pending.pop(data['username'], None)
+    elif event == 'session_down':
+        cluster.session_down(data['node'], data['username'])
+        if data['offline_since'] is not None:
+            offline_pending[data['username']] = data['offline_since']
+    elif event == 'presence':
+        if data['status'] == 'offline':
+            offline_pending.pop(data['username'], None)
+        queue_presence(data['username'], data['status'], data['friends'])
+    elif event == 'chat':
+        # The change is in the database already; reload the chat unless this
+        # worker holds that version or a newer one
+        chat_id, version = data['chat_id'], data['version']
+        current = chat_registry.get(chat_id)
+        if version is None:
+            chat_registry.apply_remote(chat_id, None)
+        elif current is None or current.get('version', 0) < version:
+            chat_registry.apply_remote(chat_id, run_io(storage.load_chat, chat_id))
+        # Leaving rooms comes as its own event, after whatever was sent to
+        # the chat first; joining can happen right away
+        for username in (chat_registry.get(chat_id) or {}).get('participants', ()):
+            for sid in online_users.get(username, ()):
+                socketio.server.enter_room(sid, chat_room(chat_id), namespace='/')
+    elif event == 'leave':
+        for sid in online_users.get(data['username'], ()):
+            socketio.server.leave_room(sid, chat_room(data['chat_id']), namespace='/')
+    elif event == 'post':
+        if cluster.owns(data['chat_id']) and data['chat_id'] in chat_registry:
+            queue_message(data['chat_id'], data['message'], data['queued_at'])
+    elif event == 'resync':
+        chats = {
+            chat_id: resync_result(chat_id, last_seq)
+            for chat_id, last_seq in data['chats'].items()
+            if cluster.owns(chat_id) and chat_id in chat_registry
+        }
+        if chats:
+            socketio.emit('resync_result', {'chats': chats}, to=data['sid'])
+    elif event == 'mailbox':
+        sids = online_users.get(data['username'])
+        if sids:
+            socketio.start_background_task(deliver_mailbox, data['username'], next(iter(sids)))
+    elif event == 'refresh_revoked':
+        refresh_tokens.forget(data['token_hash'])
+    elif event == 'token_revoked':
+        token_cache.revoke_key(bytes.fromhex(data['key']), data['exp'])
+
+
 # WebSocket Events
 
+def start_session(sid, username):
+    """Register an authenticated socket and join its rooms; returns True if
+    it is the user's first session"""
+    first_session = add_session(sid, username)
+    join_room(user_room(username), sid=sid, namespace='/')
+    for chat_id in chat_registry.chats_for(username):
+        join_room(chat_room(chat_id), sid=sid, namespace='/')
+    print(f"User authenticated: {username}")
+    if first_session:
+        cluster.publish('session_up', node=cluster.node, username=username)
+    return first_session and not cluster.remote_online(username)
+
+def welcome_session(sid, username, first_session):
+    """Announce the user and send the new session its initial state"""
+    # Notify friends (only when the user comes online, not per device, and
+    # not when they come back within the offline grace period)
+    user_friends = load_user_friends(username)
+    if first_session and offline_pending.pop(username, None) is None:
+        announce_presence(username, 'online', user_friends)
+    
+    # Include friends' presence so the client doesn't need GET /api/friends
+    socketio.emit('authenticated', {
+        'username': username,
+        'presence': presence_snapshot(username, user_friends)
+    }, to=sid)
+    
+    # Hand over everything that arrived while the user was offline
+    deliver_mailbox(username, sid)
+
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
+    # The connection budget was checked when the Engine.IO socket opened
+    # (handle_eio_connect). Refusals here carry 'unauthorized' in the
+    # CONNECT_ERROR packet, after which clients log in again.
+    token = auth.get('token') if isinstance(auth, dict) else None
+    if token is None:
+        if REQUIRE_HANDSHAKE_AUTH:
+            metrics['connections_unauthenticated'] += 1
+            raise ConnectionRefusedError('unauthorized')
+        # Legacy client; run_auth_reaper closes it if it never authenticates
+        print(f"Client connected: {request.sid}")
+        emit('connected', {'message': 'Connected to server'})
+        return
+    
+    # Authenticated in the handshake: refuse bad tokens before any session
+    # state exists, otherwise the user is online as soon as the socket is
+    username = verify_token(token)
+    if not username:
+        metrics['connections_unauthenticated'] += 1
+        raise ConnectionRefusedError('unauthorized')
     print(f"Client connected: {request.sid}")
-    emit('connected', {'message': 'Connected to server'})
+    first_session = start_session(request.sid, username)
+    
+    # Events emitted from the connect handler would go out before the
+    # CONNECT acknowledgement, so send the initial state right after it
+    socketio.start_background_task(welcome_session, request.sid, username, first_session)
 
 @socketio.on('ping')
 def handle_ping():
@@ -692,6 +2935,7 @@ def handle_heartbeat():
 
 @socketio.on('authenticate')
 def handle_authenticate(data):
+    """Legacy login for clients that don't authenticate in the handshake"""
     token = data.get('token')
     username = verify_token(token)
     
@@ -700,43 +2944,33 @@ def handle_authenticate(data):
         disconnect()
         return
     
-    # Store session
-    user_sessions[request.sid] = username
-    online_users[username] = request.sid
-    
-    print(f"User authenticated: {username}")
-    
-    # Notify friends
-    user_friends = load_user_friends(username)
+    if user_sessions.get(request.sid) == username:
+        return  # Already authenticated in the handshake
     
-    for friend_username, status in user_friends.items():
-        if status == 'accepted' and friend_username in online_users:
-            socketio.emit('user_online', {
-                'username': username
-            }, room=online_users[friend_username])
-    
-    emit('authenticated', {'username': username})
+    # Store session; a user is online while any of their sessions is
+    first_session = start_session(request.sid, username)
+    welcome_session(request.sid, username, first_session)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    if request.sid in user_sessions:
-        username = user_sessions[request.sid]
-        
-        # Remove from online users
-        if username in online_users:
-            del online_users[username]
-        del user_sessions[request.sid]
-        
+    # Remove this session; the user stays online while another device is
+    username, last_session = remove_session(request.sid)
+    pending_presence.pop(request.sid, None)
+    saturated_since.pop(request.sid, None)
+    typing_backlogged.discard(request.sid)
+    if username is not None:
         print(f"User disconnected: {username}")
-        
-        # Notify friends
-        user_friends = load_user_friends(username)
-        
-        for friend_username, status in user_friends.items():
-            if status == 'accepted' and friend_username in online_users:
-                socketio.emit('user_offline', {
-                    'username': username
-                }, room=online_users[friend_username])
+    
+    if last_session:
+        presence_versions.pop(username, None)  # Next session starts from a new snapshot
+        disconnected_at = None
+        if not cluster.remote_online(username):
+            # Notify friends once the grace period passes without a reconnect
+            disconnected_at = time.time()
+            offline_pending[username] = disconnected_at
+            socketio.start_background_task(announce_offline_after_grace, username, disconnected_at)
+        cluster.publish('session_down', node=cluster.node, username=username,
+                        offline_since=disconnected_at)
 
 @socketio.on('send_message')
 def handle_send_message(data):
@@ -757,40 +2991,90 @@ def handle_send_message(data):
         if not message_text:
             return
         
-        chats_data = load_json(CHATS_FILE, {})
+        chat = chat_registry.get(chat_id)
         
-        if chat_id not in chats_data:
+        if chat is None:
             emit('error', {'message': 'Chat not found'})
             return
         
-        if username not in chats_data[chat_id]['participants']:
+        if not chat_registry.is_member(chat_id, username):
             emit('error', {'message': 'Not a participant'})
             return
         
-        # Create message (not saved on server - privacy!)
-        message = {
-            'id': f"msg_{int(time.time() * 1000)}",
+        # Create message (not saved on server - privacy! Only the last few
+        # per chat are kept in memory for resync)
+        message = post_message(chat_id, {
+            'id': ids.new('msg'),
             'sender': username,
             'message': message_text,
             'timestamp': datetime.now().isoformat(),
             'is_action': is_action
-        }
+        })
         
-        # Broadcast to all participants (they save locally)
-        for participant in chats_data[chat_id]['participants']:
-            if participant in online_users:
-                socketio.emit('new_message', {
-                    'chat_id': chat_id,
-                    'message': message
-                }, room=online_users[participant])
-        
-        # Acknowledge message sent
-        emit('message_sent', {'message_id': message['id'], 'status': 'success'})
+        # Acknowledge message sent; participants get it (and save it
+        # locally) from the fanout workers, so this doesn't wait on large groups
+        emit('message_sent', {'message_id': message['id'], 'seq': message.get('seq'), 'status': 'success'})
         
     except Exception as e:
         print(f"Error in send_message: {e}")
         emit('error', {'message': 'Failed to send message'})
 
+@socketio.on('resync')
+def handle_resync(data):
+    """
+    Gap fill after a reconnect: takes {chat_id: last_seq} and replies with
+    the newer messages still held in memory. 'complete' is False when some
+    of the missing range has already left the recent-message ring.
+    """
+    if request.sid not in user_sessions:
+        emit('error', {'message': 'Not authenticated'})
+        return
+    
+    username = user_sessions[request.sid]
+    chats, elsewhere = {}, {}
+    for chat_id, last_seq in (data or {}).items():
+        if not chat_registry.is_member(chat_id, username) or not isinstance(last_seq, int):
+            continue
+        if cluster.owns(chat_id):
+            chats[chat_id] = resync_result(chat_id, last_seq)
+        else:
+            elsewhere[chat_id] = last_seq
+    
+    # Each chat's messages are kept by the worker that owns it, which
+    # answers this session with a resync_result of its own
+    if elsewhere:
+        cluster.publish('resync', sid=request.sid, chats=elsewhere)
+    emit('resync_result', {'chats': chats})
+
+def emit_typing_event(event, chat_id, username):
+    """Send a typing event to the other online participants of a chat.
+    Typing is the lowest priority, so sessions that run_outbound_monitor
+    last found backed up don't get it."""
+    if chat_id not in chat_registry:
+        return
+    skip_sids = list(online_users.get(username, ()))
+    for sid in typing_backlogged:
+        if sid not in skip_sids and chat_registry.is_member(chat_id, user_sessions.get(sid)):
+            skip_sids.append(sid)
+            metrics['typing_dropped'] += 1
+    socketio.emit(event, {
+        'chat_id': chat_id,
+        'username': username
+    }, room=chat_room(chat_id), skip_sid=skip_sids)
+
+def run_typing_window(username, chat_id):
+    """Background task: re-announce or end typing when the window expires"""
+    key = (username, chat_id)
+    while True:
+        socketio.sleep(TYPING_WINDOW)
+        if typing_windows.get(key) and chat_registry.is_member(chat_id, username):
+            typing_windows[key] = False
+            emit_typing_event('user_typing', chat_id, username)
+        else:
+            typing_windows.pop(key, None)
+            emit_typing_event('user_stopped_typing', chat_id, username)
+            return
+
 @socketio.on('typing')
 def handle_typing(data):
     if request.sid not in user_sessions:
@@ -799,24 +3083,116 @@ def handle_typing(data):
     username = user_sessions[request.sid]
     chat_id = data.get('chat_id')
     
-    chats_data = load_json(CHATS_FILE, {})
-    if chat_id in chats_data and username in chats_data[chat_id]['participants']:
-        for participant in chats_data[chat_id]['participants']:
-            if participant != username and participant in online_users:
-                socketio.emit('user_typing', {
-                    'chat_id': chat_id,
-                    'username': username
-                }, room=online_users[participant])
+    if not chat_registry.is_member(chat_id, username):
+        return
+    
+    # Coalesce keystrokes: only the first event of a window is sent right away
+    key = (username, chat_id)
+    if key in typing_windows:
+        typing_windows[key] = True
+        return
+    
+    typing_windows[key] = False
+    emit_typing_event('user_typing', chat_id, username)
+    socketio.start_background_task(run_typing_window, username, chat_id)
+
+# Cluster
+
+def run_bus_broker(path):
+    """Cluster parent: relay every frame a worker publishes to all
+    subscribed workers, in the order each publisher sent them"""
+    if os.path.exists(path):
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    subscribers = {}  # {connection: Semaphore} so frames never interleave
+    
+    def serve(conn):
+        try:
+            role = conn.recv(1)
+            if role == b'S':
+                subscribers[conn] = Semaphore()
+                conn.recv(1)  # Subscribers never send; returns once they hang up
+                return
+            while True:
+                payload = recv_frame(conn)
+                for subscriber, lock in list(subscribers.items()):
+                    try:
+                        with lock:
+                            send_frame(subscriber, payload)
+                    except OSError:
+                        subscribers.pop(subscriber, None)
+        except OSError:
+            pass
+        finally:
+            subscribers.pop(conn, None)
+            conn.close()
+    
+    while True:
+        conn, _ = listener.accept()
+        socketio.start_background_task(serve, conn)
+
+def run_cluster():
+    """Cluster parent: run CLUSTER_WORKERS worker processes on the same port
+    and restart any that exit"""
+    if CLUSTER_BUS.startswith('unix://'):
+        socketio.start_background_task(run_bus_broker, CLUSTER_BUS[len('unix://'):])
+    workers = {}
+    try:
+        while True:
+            for node in range(CLUSTER_WORKERS):
+                worker = workers.get(node)
+                if worker is not None and worker.poll() is None:
+                    continue
+                if worker is not None:
+                    print(f"Worker {node} exited with {worker.returncode}, restarting")
+                workers[node] = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), 'worker', str(node)]
+                )
+            socketio.sleep(1)
+    finally:
+        for worker in workers.values():
+            worker.terminate()
 
 if __name__ == '__main__':
-    # Initialize files if they don't exist
-    if not os.path.exists(USERS_INDEX_FILE):
-        save_json(USERS_INDEX_FILE, {})
-    if not os.path.exists(CHATS_FILE):
-        save_json(CHATS_FILE, {})
-    
-    print(f"Starting NVDA Chat Server v2.0 on port 8080")
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-sqlite':
+        sys.exit(0 if migrate_json_to_sqlite() else 1)
+    
+    if CLUSTER_WORKERS > 1 and not cluster.enabled:
+        print(f"Starting NVDA Chat Server v2.0 on port {PORT} with {CLUSTER_WORKERS} workers")
+        print(f"Cluster bus: {CLUSTER_BUS}")
+        run_cluster()
+        sys.exit(0)
+    
+    socketio.start_background_task(chat_registry.run_flusher)
+    for queue in fanout_queues:
+        socketio.start_background_task(run_fanout_worker, queue)
+    socketio.start_background_task(run_outbound_monitor)
+    socketio.start_background_task(run_auth_reaper)
+    socketio.start_background_task(run_presence_batcher)
+    if not cluster.enabled or cluster.node == 0:
+        socketio.start_background_task(mailboxes.run_cleanup)
+    if MIGRATE_USER_DIRS and isinstance(storage, JsonStorage):
+        socketio.start_background_task(user_dirs.run_migration)
+    socketio.start_background_task(storage.run_maintenance)
+    
+    if cluster.enabled:
+        # Listen on the bus from the start, not from the first connection
+        socketio.server.manager_initialized = True
+        socketio.server.manager.initialize()
+        socketio.start_background_task(cluster.run_heartbeat)
+        print(f"Worker {cluster.node} (pid {os.getpid()}) serving on port {PORT}")
+        # Every worker listens on the same port and the kernel spreads
+        # incoming connections between them
+        eventlet.wsgi.server(
+            eventlet.listen(('0.0.0.0', PORT), reuse_port=True), app, log_output=False
+        )
+        sys.exit(0)
+    
+    print(f"Starting NVDA Chat Server v2.0 on port {PORT}")
     print(f"Data directory: {DATA_PATH}")
-    print(f"User folders: {USERS_DIR}")
+    print(f"Storage backend: {STORAGE_BACKEND}")
+    print(f"User folders: {USER_SHARDS_DIR}")
     print("Messages stored locally on client devices for privacy")
-    socketio.run(app, host='0.0.0.0', port=8080, debug=False)
+    socketio.run(app, host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,72 @@
+"""Test setup: run the server module against a throwaway data directory"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+DATA_DIR = tempfile.mkdtemp(prefix='nvda-chat-tests-')
+os.environ['NVDA_CHAT_DATA'] = DATA_DIR
+# Registered before server is imported, so it runs after storage.close()
+atexit.register(shutil.rmtree, DATA_DIR, True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def users():
+    """Adds users straight to the credential index, with an empty password"""
+    def add(*usernames):
+        for username in usernames:
+            server.user_index.add(username, {'password': '', 'created_at': datetime.now().isoformat()})
+        return list(usernames)
+    return add
+
+
+@pytest.fixture
+def headers():
+    """Authorization headers for the HTTP API"""
+    return lambda username: {'Authorization': f'Bearer {server.create_token(username)}'}
+
+
+@pytest.fixture
+def group_chat(users):
+    """Registers a group chat (and its members), the first member as admin"""
+    def create(members, name='group'):
+        users(*members)
+        chat_id = server.ids.new('chat')
+        server.chat_registry.add(chat_id, {
+            'type': 'group', 'name': name, 'participants': list(members),
+            'created_by': members[0], 'admin': members[0]
+        })
+        return chat_id
+    return create
+
+
+@pytest.fixture
+def connected():
+    """Socket.IO test clients authenticated in the handshake, with the
+    welcome events already read; any still connected are closed afterwards"""
+    clients = []
+
+    def connect(*usernames):
+        opened = {
+            username: server.socketio.test_client(server.app, auth={'token': server.create_token(username)})
+            for username in usernames
+        }
+        clients.extend(opened.values())
+        server.socketio.sleep(0.1)  # let welcome_session run
+        for client in opened.values():
+            client.get_received()
+        return opened
+
+    yield connect
+    for client in clients:
+        if client.is_connected():
+            client.disconnect()
@@ -0,0 +1,83 @@
+"""Registration and login against the credential index"""
+
+import time
+
+import bcrypt
+import eventlet
+
+import server
+
+
+def register(username):
+    return server.app.test_client().post('/api/auth/register', json={
+        'username': username, 'password': 'secret'
+    })
+
+
+def test_register_then_login():
+    assert register('frank').status_code == 200
+    assert register('frank').status_code == 409
+    response = server.app.test_client().post('/api/auth/login', json={
+        'username': 'frank', 'password': 'secret'
+    })
+    assert response.status_code == 200
+    assert server.verify_token(response.get_json()['token']) == 'frank'
+
+
+def test_register_rolls_back_when_storage_fails(monkeypatch):
+    monkeypatch.setattr(server.storage, 'add_user', lambda username, record: False)
+    assert register('gina').status_code == 500
+    assert 'gina' not in server.user_index
+    monkeypatch.undo()
+    assert register('gina').status_code == 200
+
+
+def test_refresh_rotates_the_refresh_token():
+    client = server.app.test_client()
+    first = register('hank').get_json()['refresh_token']
+    response = client.post('/api/auth/refresh', json={'refresh_token': first})
+    assert response.status_code == 200
+    second = response.get_json()['refresh_token']
+    assert second != first
+    assert client.post('/api/auth/refresh', json={'refresh_token': first}).status_code == 401
+
+    client.post('/api/auth/logout', json={'refresh_token': second})
+    assert client.post('/api/auth/refresh', json={'refresh_token': second}).status_code == 401
+
+
+def test_token_cache_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(server, 'token_cache', server.TokenCache(0))
+    token = server.create_token('ivy')
+    assert server.verify_token(token) == 'ivy'
+    assert server.verify_token(token) == 'ivy'
+    assert not server.token_cache.entries
+    server.token_cache.revoke(token, server.decode_token(token)['exp'])
+    assert server.verify_token(token) is None
+
+
+def test_fanout_keeps_flowing_during_a_login_storm(group_chat, connected):
+    record = {'password': bcrypt.hashpw(b'secret', bcrypt.gensalt(12)).decode('utf-8'), 'created_at': ''}
+    stormers = [f'storm{i}' for i in range(8)]
+    for username in stormers:
+        server.user_index.users[username] = record
+    chat_id = group_chat(['poster', 'reader'], 'storm')
+    clients = connected('poster', 'reader')
+    client = server.app.test_client()
+
+    # bcrypt runs on I/O threads, so the hub keeps delivering messages
+    pool = eventlet.GreenPool()
+    logins = [
+        pool.spawn(client.post, '/api/auth/login', json={'username': username, 'password': 'secret'})
+        for username in stormers
+    ]
+    delays = []
+    while pool.running():
+        started = time.perf_counter()
+        eventlet.sleep(0.01)
+        server.deliver_message(chat_id, {'chat_id': chat_id, 'message': {'message': 'still here'}})
+        delays.append(time.perf_counter() - started - 0.01)
+    assert all(login.wait().status_code == 200 for login in logins)
+    assert len(delays) >= 10
+    assert max(delays) < 0.1, max(delays)
+    received = [packet for packet in clients['reader'].get_received() if packet['name'] == 'new_message']
+    assert len(received) == len(delays)
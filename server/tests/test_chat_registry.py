@@ -0,0 +1,86 @@
+"""ChatRegistry membership indexes against a full scan of the chats"""
+
+import random
+
+import server
+
+
+def scan_chats_for(registry, username):
+    return {
+        chat_id for chat_id, chat_info in registry.items()
+        if username in chat_info['participants']
+    }
+
+
+def scan_private_chat(registry, participants):
+    for chat_id, chat_info in registry.items():
+        if chat_info['type'] == 'private' and sorted(chat_info['participants']) == sorted(participants):
+            return chat_id
+    return None
+
+
+def check_indexes(registry, usernames):
+    for username in usernames:
+        assert set(registry.chats_for(username)) == scan_chats_for(registry, username)
+    for chat_id, chat_info in registry.items():
+        for username in usernames:
+            assert registry.is_member(chat_id, username) == (username in chat_info['participants'])
+    for a in usernames:
+        for b in usernames:
+            if a < b:
+                assert registry.find_private_chat([a, b]) == scan_private_chat(registry, [a, b])
+
+
+def random_operations(registry, rng, usernames, steps):
+    for _ in range(steps):
+        chat_ids = list(registry.chats)
+        groups = [chat_id for chat_id in chat_ids if registry.get(chat_id)['type'] == 'group']
+        op = rng.choice(['private', 'group', 'add', 'remove', 'delete'])
+        if op == 'private':
+            pair = rng.sample(usernames, 2)
+            if registry.find_private_chat(pair) is None:
+                registry.add(server.ids.new('chat'), {'type': 'private', 'participants': pair})
+        elif op == 'group':
+            members = rng.sample(usernames, rng.randint(1, len(usernames)))
+            registry.add(server.ids.new('chat'), {
+                'type': 'group', 'name': 'g', 'participants': members,
+                'admin': members[0], 'created_by': members[0]
+            })
+        elif op == 'add' and groups:
+            chat_id = rng.choice(groups)
+            outsiders = [u for u in usernames if not registry.is_member(chat_id, u)]
+            if outsiders:
+                registry.add_participant(chat_id, rng.choice(outsiders))
+        elif op == 'remove' and groups:
+            chat_id = rng.choice(groups)
+            members = registry.get(chat_id)['participants']
+            if members:
+                registry.remove_participant(chat_id, rng.choice(members))
+        elif op == 'delete' and chat_ids:
+            registry.remove(rng.choice(chat_ids))
+        yield op
+
+
+def test_indexes_match_full_scan():
+    usernames = [f'user{i}' for i in range(12)]
+    for seed in range(20):
+        rng = random.Random(seed)
+        registry = server.ChatRegistry(server.storage)
+        for _ in random_operations(registry, rng, usernames, 300):
+            check_indexes(registry, usernames)
+
+
+def test_indexes_rebuilt_on_load(tmp_path):
+    usernames = [f'user{i}' for i in range(8)]
+    storage = server.SqliteStorage(str(tmp_path / 'chats.db'))
+    storage.initialize()
+    registry = server.ChatRegistry(storage)
+    for _ in random_operations(registry, random.Random(1), usernames, 500):
+        pass
+    assert registry.flush()
+
+    loaded = server.ChatRegistry(storage)
+    loaded.load()
+    assert set(loaded.chats) == set(registry.chats)
+    check_indexes(loaded, usernames)
+    storage.close()
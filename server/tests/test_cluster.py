@@ -0,0 +1,231 @@
+"""Two cluster workers on separate ports exchanging messages over the unix bus"""
+
+import hashlib
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import socketio
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(check, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError('Timed out waiting for the cluster')
+
+
+def post(port, path, data, token=None):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}{path}', data=json.dumps(data).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def get(port, path, token):
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}{path}', headers={'Authorization': f'Bearer {token}'}
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def owner_of(chat_id):
+    return int(hashlib.md5(chat_id.encode('utf-8')).hexdigest()[:8], 16) % 2
+
+
+class Ports(list):
+    """Worker ports, plus a way to restart a worker on its port"""
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    """Broker plus workers 0 and 1, each worker on its own port"""
+    bus = str(tmp_path / 'bus.sock')
+    env = dict(
+        os.environ, NVDA_CHAT_DATA=str(tmp_path / 'data'), NVDA_CHAT_STORAGE='sqlite',
+        NVDA_CHAT_WORKERS='2', NVDA_CHAT_BUS=f'unix://{bus}'
+    )
+    log = open(tmp_path / 'cluster.log', 'w')
+    processes = [subprocess.Popen(
+        [sys.executable, '-c', f'import server; server.run_bus_broker({bus!r})'],
+        cwd=os.path.dirname(SERVER), env=env, stdout=log, stderr=subprocess.STDOUT
+    )]
+    ports = Ports([free_port(), free_port()])
+    workers = {}
+
+    def start(node):
+        workers[node] = subprocess.Popen(
+            [sys.executable, SERVER, 'worker', str(node)],
+            env=dict(env, NVDA_CHAT_PORT=str(ports[node])), stdout=log, stderr=subprocess.STDOUT
+        )
+        processes.append(workers[node])
+
+    def stop(node):
+        workers[node].terminate()
+        workers[node].wait()
+
+    def wait_until_up(node):
+        wait_for(lambda: urllib.request.urlopen(f'http://127.0.0.1:{ports[node]}/').status == 200)
+    ports.start, ports.stop, ports.wait_until_up = start, stop, wait_until_up
+    try:
+        wait_for(lambda: os.path.exists(bus))
+        for node in range(len(ports)):
+            start(node)
+        for node in range(len(ports)):
+            wait_until_up(node)
+        yield ports
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        log.close()
+
+
+def connect(port, token):
+    received = queue.Queue()
+    client = socketio.Client()
+    for event in ('authenticated', 'new_message', 'friend_request', 'friend_accepted', 'error'):
+        client.on(event, lambda data, event=event: received.put((event, data)))
+    client.connect(f'http://127.0.0.1:{port}', transports=['websocket'], auth={'token': token})
+    assert received.get(timeout=10)[0] == 'authenticated'
+    return client, received
+
+
+def test_message_crosses_workers(cluster):
+    alice = post(cluster[0], '/api/auth/register', {'username': 'alice', 'password': 'pw'})
+    bob = post(cluster[1], '/api/auth/register', {'username': 'bob', 'password': 'pw'})
+    chat_id = post(cluster[0], '/api/chats/create',
+                   {'type': 'private', 'participants': ['bob']}, alice['token'])['chat_id']
+    owner = owner_of(chat_id)
+
+    # The sender sits on the worker that does not own the chat, so its
+    # message is posted to the owner, numbered there and fanned out over the bus
+    sender_port, receiver_port = cluster[1 - owner], cluster[owner]
+    alice_client, _ = connect(sender_port, alice['token'])
+    bob_client, bob_events = connect(receiver_port, bob['token'])
+    try:
+        # The chat reaches the other worker asynchronously
+        deadline = time.time() + 10
+        while True:
+            alice_client.emit('send_message', {'chat_id': chat_id, 'message': 'hello'})
+            try:
+                event, data = bob_events.get(timeout=1)
+                break
+            except queue.Empty:
+                assert time.time() < deadline, 'message never crossed workers'
+        assert event == 'new_message'
+        assert data['chat_id'] == chat_id
+        assert data['message']['message'] == 'hello'
+        assert data['message']['seq'] >= 1
+
+        # And the owner's fanout reaches a session on the other worker
+        alice_client.disconnect()
+        alice_client, alice_events = connect(receiver_port, alice['token'])
+        bob_client.disconnect()
+        bob_client, bob_events = connect(sender_port, bob['token'])
+        alice_client.emit('send_message', {'chat_id': chat_id, 'message': 'again'})
+        event, data = bob_events.get(timeout=10)
+        assert event == 'new_message'
+        assert data['message']['message'] == 'again'
+    finally:
+        alice_client.disconnect()
+        bob_client.disconnect()
+
+
+def test_friend_events_cross_workers(cluster):
+    alice = post(cluster[0], '/api/auth/register', {'username': 'alice', 'password': 'pw'})
+    bob = post(cluster[1], '/api/auth/register', {'username': 'bob', 'password': 'pw'})
+    alice_client, alice_events = connect(cluster[0], alice['token'])
+    bob_client, bob_events = connect(cluster[1], bob['token'])
+    try:
+        post(cluster[0], '/api/friends/add', {'username': 'bob'}, alice['token'])
+        event, data = bob_events.get(timeout=10)
+        assert (event, data['from']) == ('friend_request', 'alice')
+
+        post(cluster[1], '/api/friends/accept', {'username': 'alice'}, bob['token'])
+        event, data = alice_events.get(timeout=10)
+        assert (event, data['username']) == ('friend_accepted', 'bob')
+    finally:
+        alice_client.disconnect()
+        bob_client.disconnect()
+
+
+def group_participants(port, token, chat_id):
+    chats = get(port, '/api/chats', token)['chats']
+    return {chat['chat_id']: set(chat['participants']) for chat in chats}.get(chat_id)
+
+
+def test_group_changes_on_both_workers_all_land(cluster):
+    admin = post(cluster[0], '/api/auth/register', {'username': 'admin', 'password': 'pw'})['token']
+    chat_id = post(cluster[0], '/api/chats/create',
+                   {'type': 'group', 'name': 'both', 'participants': ['seed']}, admin)['chat_id']
+    wait_for(lambda: group_participants(cluster[1], admin, chat_id))
+
+    # Adds and removes for the same group race each other on both workers
+    members = [f'member{i}' for i in range(40)]
+    calls = [(cluster[i % 2], '/api/chats/group/add-member', member) for i, member in enumerate(members)]
+    calls += [(cluster[1], '/api/chats/group/remove-member', 'seed')]
+    with ThreadPoolExecutor(16) as pool:
+        list(pool.map(lambda call: post(call[0], call[1], {'chat_id': chat_id, 'username': call[2]}, admin),
+                      calls))
+
+    expected = {'admin', *members}
+    for port in cluster:
+        wait_for(lambda: group_participants(port, admin, chat_id) == expected)
+
+
+def test_private_chat_created_once_across_workers(cluster):
+    alice = post(cluster[0], '/api/auth/register', {'username': 'alice', 'password': 'pw'})['token']
+    bob = post(cluster[1], '/api/auth/register', {'username': 'bob', 'password': 'pw'})['token']
+    with ThreadPoolExecutor(2) as pool:
+        chat_ids = list(pool.map(
+            lambda call: post(call[0], '/api/chats/create',
+                              {'type': 'private', 'participants': [call[2]]}, call[1])['chat_id'],
+            [(cluster[0], alice, 'bob'), (cluster[1], bob, 'alice')]
+        ))
+    assert chat_ids[0] == chat_ids[1]
+
+
+def test_chat_changes_kept_while_owner_restarts(cluster):
+    admin = post(cluster[0], '/api/auth/register', {'username': 'admin', 'password': 'pw'})['token']
+    # Pick a group the second worker does not own, and take its owner down
+    while True:
+        chat_id = post(cluster[1], '/api/chats/create',
+                       {'type': 'group', 'name': 'restart', 'participants': ['seed']}, admin)['chat_id']
+        if owner_of(chat_id) == 0:
+            break
+    cluster.stop(0)
+
+    post(cluster[1], '/api/chats/group/add-member', {'chat_id': chat_id, 'username': 'late'}, admin)
+    post(cluster[1], '/api/chats/group/rename', {'chat_id': chat_id, 'new_name': 'renamed'}, admin)
+
+    cluster.start(0)
+    cluster.wait_until_up(0)
+    chats = {chat['chat_id']: chat for chat in get(cluster[0], '/api/chats', admin)['chats']}
+    assert set(chats[chat_id]['participants']) == {'admin', 'seed', 'late'}
+    assert chats[chat_id]['name'] == 'renamed'
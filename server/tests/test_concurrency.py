@@ -0,0 +1,82 @@
+"""Concurrent friends and group mutations must not lose updates"""
+
+import random
+
+import eventlet
+
+import server
+
+VALID_PAIRS = {(None, None), ('pending', 'request'), ('request', 'pending'), ('accepted', 'accepted')}
+
+
+def run_concurrently(calls, size=100):
+    pool = eventlet.GreenPool(size)
+    responses = list(pool.starmap(lambda func, *args: func(*args), calls))
+    assert all(response.status_code < 500 for response in responses)
+    return responses
+
+
+def test_friendships_stay_symmetric(users, headers):
+    usernames = users(*(f'friend{i}' for i in range(10)))
+    auth = {username: headers(username) for username in usernames}
+    client = server.app.test_client()
+    rng = random.Random(9)
+
+    def call(path, username, friend):
+        return client.post(path, json={'username': friend}, headers=auth[username])
+
+    calls = []
+    for _ in range(3000):
+        username, friend = rng.sample(usernames, 2)
+        path = rng.choice(['add', 'add', 'accept', 'reject', 'delete'])
+        calls.append((call, f'/api/friends/{path}', username, friend))
+    run_concurrently(calls)
+
+    friends = {username: server.storage.load_friends(username) for username in usernames}
+    accepted = 0
+    for a in usernames:
+        for b in usernames:
+            if a < b:
+                pair = (friends[a].get(b), friends[b].get(a))
+                assert pair in VALID_PAIRS, (a, b, pair)
+                accepted += pair == ('accepted', 'accepted')
+    assert accepted
+
+
+def test_group_members_not_lost(monkeypatch, users, headers):
+    # Yield between the membership check and the change, as a slower
+    # registry would, so unlocked requests interleave inside it
+    is_member = server.chat_registry.is_member
+
+    def yielding_is_member(chat_id, username):
+        member = is_member(chat_id, username)
+        eventlet.sleep(0)
+        return member
+    monkeypatch.setattr(server.chat_registry, 'is_member', yielding_is_member)
+    admin, *others = users(*(f'member{i}' for i in range(301)))
+    client = server.app.test_client()
+    auth = headers(admin)
+    response = client.post('/api/chats/create', headers=auth, json={
+        'type': 'group', 'name': 'stress', 'participants': others[:100]
+    })
+    chat_id = response.get_json()['chat_id']
+
+    def call(path, member):
+        return client.post(path, json={'chat_id': chat_id, 'username': member}, headers=auth)
+
+    removed, added = others[:100], others[100:]
+    calls = [('/api/chats/group/remove-member', member) for member in removed]
+    calls += [('/api/chats/group/add-member', member) for member in added]
+    calls += [('/api/chats/group/add-member', member) for member in added[:100]]  # duplicates
+    random.Random(3).shuffle(calls)
+    run_concurrently([(call, path, member) for path, member in calls])
+
+    expected = {admin, *added}
+    participants = server.chat_registry.get(chat_id)['participants']
+    assert sorted(participants) == sorted(expected)
+    for member in others:
+        assert server.chat_registry.is_member(chat_id, member) == (member in expected)
+        assert (chat_id in server.chat_registry.chats_for(member)) == (member in expected)
+
+    assert server.chat_registry.flush()
+    assert set(server.storage.load_chats()[chat_id]['participants']) == expected
@@ -0,0 +1,46 @@
+"""Connection budget and auth deadline, enforced on Engine.IO sockets"""
+
+import json
+
+import eventlet
+import eventlet.wsgi
+import pytest
+from eventlet.green.urllib import error, request
+
+import server
+
+
+@pytest.fixture
+def port():
+    """The app served over HTTP in this process"""
+    listener = eventlet.listen(('127.0.0.1', 0))
+    thread = eventlet.spawn(eventlet.wsgi.server, listener, server.app, log_output=False)
+    yield listener.getsockname()[1]
+    thread.kill()
+
+
+def open_engineio(port):
+    """Open an Engine.IO session that never sends a Socket.IO CONNECT"""
+    try:
+        with request.urlopen(f'http://127.0.0.1:{port}/socket.io/?EIO=4&transport=polling') as response:
+            return response.status, response.read()
+    except error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_sockets_without_connect_count_and_are_reaped(monkeypatch, port):
+    monkeypatch.setattr(server, 'MAX_CONNECTIONS', len(server.connections) + 2)
+    monkeypatch.setattr(server, 'AUTH_DEADLINE', 0.2)
+    assert open_engineio(port)[0] == 200
+    assert open_engineio(port)[0] == 200
+    status, body = open_engineio(port)
+    assert (status, json.loads(body)) == (401, 'busy')
+
+    reaped = server.metrics['connections_reaped']
+    reaper = eventlet.spawn(server.run_auth_reaper)
+    try:
+        eventlet.sleep(0.5)
+    finally:
+        reaper.kill()
+    assert server.metrics['connections_reaped'] == reaped + 2
+    assert open_engineio(port)[0] == 200
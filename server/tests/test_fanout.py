@@ -0,0 +1,147 @@
+"""Fanout of chat messages, offline mailbox writes and typing events"""
+
+import json
+import os
+import time
+
+import eventlet
+import pytest
+
+import server
+
+
+def test_chunked_fanout_encodes_once(monkeypatch, group_chat, connected):
+    monkeypatch.setattr(server, 'FANOUT_CHUNK_SIZE', 2)
+    members = [f'fanout{i}' for i in range(5)]
+    chat_id = group_chat(members, 'fanout')
+    clients = connected(*members)
+
+    server.deliver_message(chat_id, {'chat_id': chat_id, 'message': {'message': 'hi'}})
+
+    assert server.metrics['last_encodes_per_message'] == 1
+    for client in clients.values():
+        received = [packet for packet in client.get_received() if packet['name'] == 'new_message']
+        assert [packet['args'][0]['message']['message'] for packet in received] == ['hi']
+
+
+def test_offline_participants_stored_in_one_io_call(monkeypatch):
+    calls = []
+    run_io = server.run_io
+    monkeypatch.setattr(server, 'run_io', lambda func, *args: calls.append(func) or run_io(func, *args))
+    participants = [f'away{i}' for i in range(20)]
+    payload = {'chat_id': 'chat_1', 'message': {'message': 'while you were out'}}
+
+    server.store_for_offline('chat_1', participants, payload)
+
+    assert len(calls) == 1
+    for participant in participants:
+        [entry], _ = server.mailboxes.drain(participant)
+        assert entry['message'] == payload['message']
+
+
+def test_typing_skips_backlogged_sessions(monkeypatch, group_chat, connected):
+    monkeypatch.setattr(server, 'outbound_depth', lambda sid: pytest.fail('typing checked a queue'))
+    members = ['typist', 'slow', 'quick']
+    chat_id = group_chat(members, 'typing')
+    clients = connected(*members)
+    slow_sid = next(iter(server.online_users['slow']))
+    server.typing_backlogged.add(slow_sid)
+    dropped = server.metrics['typing_dropped']
+
+    server.emit_typing_event('user_typing', chat_id, 'typist')
+
+    def typing_events(member):
+        return [packet for packet in clients[member].get_received() if packet['name'] == 'user_typing']
+    assert typing_events('slow') == []
+    assert len(typing_events('quick')) == 1
+    assert typing_events('typist') == []
+    assert server.metrics['typing_dropped'] == dropped + 1
+    for client in clients.values():
+        client.disconnect()
+    assert slow_sid not in server.typing_backlogged
+
+
+def test_fanout_keeps_each_chat_in_order(users):
+    users('sender', 'absent')
+    chat_id = server.ids.new('chat')
+    server.chat_registry.add(chat_id, {
+        'type': 'private', 'name': '', 'participants': ['sender', 'absent'],
+        'created_by': 'sender', 'admin': None
+    })
+    workers = [eventlet.spawn(server.run_fanout_worker, queue) for queue in server.fanout_queues]
+    try:
+        for i in range(500):
+            server.queue_message(chat_id, {'message': f'message {i}'}, time.time())
+        deadline = time.time() + 30
+        while len(mailbox_seqs('absent')) < 500 and time.time() < deadline:
+            eventlet.sleep(0.05)
+    finally:
+        for worker in workers:
+            worker.kill()
+    assert mailbox_seqs('absent') == list(range(1, 501))
+
+
+def mailbox_seqs(username):
+    """Message seqs in a mailbox's files, in the order they were appended"""
+    mailbox = server.mailboxes.path(username)
+    seqs = []
+    for name in server.mailboxes.segments(mailbox):
+        with open(os.path.join(mailbox, name), encoding='utf-8') as f:
+            seqs += [json.loads(line)['message']['seq'] for line in f]
+    return seqs
+
+
+def test_mailbox_kept_until_acknowledged(users):
+    users('returning')
+    queued = [('chat_b', 2), ('chat_a', 1), ('chat_b', 1)]
+    server.mailboxes.append_many(['returning'], [
+        {'chat_id': chat_id, 'message': {'seq': seq}, 'queued_at': time.time()} for chat_id, seq in queued
+    ])
+
+    def reconnect():
+        client = server.socketio.test_client(server.app, auth={'token': server.create_token('returning')})
+        server.socketio.sleep(0.1)
+        missed = [packet['args'][0]['messages'] for packet in client.get_received()
+                  if packet['name'] == 'missed_messages']
+        return client, [[(entry['chat_id'], entry['message']['seq']) for entry in batch] for batch in missed]
+
+    # Dropped before acknowledging: the next session gets the same batch
+    client, missed = reconnect()
+    assert missed == [[('chat_a', 1), ('chat_b', 1), ('chat_b', 2)]]
+    client.disconnect()
+    client, missed = reconnect()
+    assert missed == [[('chat_a', 1), ('chat_b', 1), ('chat_b', 2)]]
+
+    sid = next(iter(server.online_users['returning']))
+    manager = server.socketio.server.manager
+    [ack_id] = [key for key in manager.callbacks[sid] if key]
+    manager.trigger_callback(sid, ack_id, [])
+    client.disconnect()
+    client, missed = reconnect()
+    assert missed == []
+    client.disconnect()
+
+
+def test_typing_throttled_to_one_event_per_window(monkeypatch, group_chat, connected):
+    monkeypatch.setattr(server, 'TYPING_WINDOW', 0.2)
+    chat_id = group_chat(['writer', 'watcher'], 'throttle')
+    clients = connected('writer', 'watcher')
+    # Typing never touches storage or the mailboxes
+    monkeypatch.setattr(server, 'run_io', lambda *args: pytest.fail('typing did I/O'))
+    monkeypatch.setattr('builtins.open', lambda *args, **kwargs: pytest.fail('typing opened a file'))
+
+    def typing_events():
+        return [packet['name'] for packet in clients['watcher'].get_received()
+                if packet['name'] in ('user_typing', 'user_stopped_typing')]
+
+    for _ in range(10):
+        clients['writer'].emit('typing', {'chat_id': chat_id})
+    assert typing_events() == ['user_typing']
+
+    # Kept typing during the window: announced once more, then stopped
+    server.socketio.sleep(0.3)
+    assert typing_events() == ['user_typing']
+    server.socketio.sleep(0.2)
+    assert typing_events() == ['user_stopped_typing']
+    assert ('writer', chat_id) not in server.typing_windows
+    monkeypatch.undo()  # The clients disconnect after this; that may do I/O
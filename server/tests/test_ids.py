@@ -0,0 +1,55 @@
+"""IdAllocator: unique across threads and processes, ordered by time"""
+
+import multiprocessing
+import threading
+from array import array
+
+import server
+
+PROCESSES = 4
+THREADS = 4
+IDS_PER_THREAD = 125000
+
+
+def allocate(node_id):
+    """Worker process: allocate ids from several threads at once"""
+    allocator = server.IdAllocator(node_id)
+    results = [None] * THREADS
+
+    def run(index):
+        ids = array('Q', (allocator.next_id() for _ in range(IDS_PER_THREAD)))
+        assert all(a < b for a, b in zip(ids, ids[1:]))
+        results[index] = ids
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    combined = array('Q')
+    for ids in results:
+        combined.extend(ids)
+    return combined.tobytes()
+
+
+def test_concurrent_allocation_has_no_collisions():
+    context = multiprocessing.get_context('fork')
+    with context.Pool(PROCESSES) as pool:
+        chunks = pool.map(allocate, range(PROCESSES))
+    ids = array('Q')
+    for chunk in chunks:
+        ids.frombytes(chunk)
+    assert len(ids) == PROCESSES * THREADS * IDS_PER_THREAD
+    ids = sorted(ids)
+    assert all(a != b for a, b in zip(ids, ids[1:]))
+
+
+def test_ids_never_go_backwards(monkeypatch):
+    allocator = server.IdAllocator(5)
+    clock = iter([1000.0] * 5000 + [999.0] * 10 + [1000.5] * 10)
+    monkeypatch.setattr(server.time, 'time', lambda: next(clock))
+    ids = [allocator.next_id() for _ in range(5020)]
+    assert ids == sorted(set(ids))
+    # 5000 ids in one millisecond overflow the counter into the next one
+    assert ids[4999] >> (server.ID_NODE_BITS + server.ID_COUNTER_BITS) == 1000001
+    assert all((i >> server.ID_COUNTER_BITS) & ((1 << server.ID_NODE_BITS) - 1) == 5 for i in ids)
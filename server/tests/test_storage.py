@@ -0,0 +1,92 @@
+"""Storage backends and the JSON to SQLite migration"""
+
+import json
+
+import pytest
+
+import server
+
+
+def test_sqlite_ignores_duplicate_members(tmp_path):
+    storage = server.SqliteStorage(str(tmp_path / 'chats.db'))
+    storage.initialize()
+    chat = {'type': 'group', 'name': 'dup', 'participants': ['ann', 'ben', 'ann']}
+    assert storage.save_chats({'chat_dup': chat})
+    assert storage.load_chats()['chat_dup']['participants'] == ['ann', 'ben']
+
+
+def test_create_chat_drops_repeated_participants(users, headers):
+    users('carl', 'dora')
+    response = server.app.test_client().post('/api/chats/create', json={
+        'type': 'group', 'name': 'twice', 'participants': ['dora', 'dora', 'carl']
+    }, headers=headers('carl'))
+    chat = server.chat_registry.get(response.get_json()['chat_id'])
+    assert chat['participants'] == ['dora', 'carl']
+
+
+def test_migration_reports_failed_writes(monkeypatch, users):
+    users('erin')
+    assert server.migrate_json_to_sqlite()
+
+    monkeypatch.setattr(server.SqliteStorage, 'save_chats', lambda self, changes: False)
+    assert not server.migrate_json_to_sqlite()
+
+
+def test_sqlite_seq_saved_apart_from_members(tmp_path):
+    storage = server.SqliteStorage(str(tmp_path / 'chats.db'))
+    storage.initialize()
+    chat = {'type': 'group', 'name': 'seq', 'participants': ['ann', 'ben'], 'last_seq': 1}
+    assert storage.save_chats({'chat_seq': chat})
+    writes = storage.db.total_changes
+    assert storage.save_seqs({'chat_seq': 7})
+    assert storage.db.total_changes - writes == 1
+    assert storage.load_chats()['chat_seq'] == dict(chat, last_seq=7)
+
+
+def test_messages_flush_only_the_counter(monkeypatch, group_chat):
+    chat_id = group_chat(['hana', 'ivan'], 'counter')
+    assert server.chat_registry.flush()
+    monkeypatch.setattr(server.storage, 'save_chats', lambda changes: pytest.fail('chat rewritten'))
+    for _ in range(3):
+        server.chat_registry.record_message(chat_id, {'message': 'hi'})
+    assert server.chat_registry.flush()
+    assert server.storage.load_chats()[chat_id]['last_seq'] == 3
+
+
+def test_compaction_keeps_writes_made_while_saving(monkeypatch):
+    storage = server.storage
+    save_json = server.save_json
+
+    def save_unlocked(filepath, data):
+        assert not storage.lock.locked()
+        if filepath == server.CHATS_FILE:
+            assert storage.save_friends('late', {'early': 'pending'})
+        return save_json(filepath, data)
+    monkeypatch.setattr(server, 'save_json', save_unlocked)
+
+    assert storage.save_friends('early', {'late': 'request'})
+    assert storage.compact()
+    with open(server.JOURNAL_FILE, encoding='utf-8') as f:
+        assert [json.loads(line) for line in f] == [
+            {'op': 'friends', 'username': 'late', 'friends': {'early': 'pending'}}
+        ]
+    assert storage.load_friends('late') == {'early': 'pending'}
+    assert storage.load_friends('early') == {'late': 'request'}
+
+
+def test_sqlite_chat_changes_build_on_each_other(tmp_path):
+    # Two workers' storages on one database
+    path = str(tmp_path / 'chats.db')
+    first, second = server.SqliteStorage(path), server.SqliteStorage(path)
+    first.initialize()
+    second.initialize()
+    group = {'type': 'group', 'name': 'both', 'participants': ['ann']}
+    assert first.create_chat('chat_group', group)[0] == 'chat_group'
+    for storage, member in ((first, 'ben'), (second, 'cat')):
+        storage.change_chat('chat_group', lambda chat: dict(chat, participants=chat['participants'] + [member]))
+    chat = first.load_chat('chat_group')
+    assert (chat['participants'], chat['version']) == (['ann', 'ben', 'cat'], 3)
+
+    # A pair keeps one private chat, whichever worker creates it first
+    assert first.create_chat('chat_one', {'type': 'private', 'participants': ['ann', 'ben']})[0] == 'chat_one'
+    assert second.create_chat('chat_two', {'type': 'private', 'participants': ['ben', 'ann']})[0] == 'chat_one'